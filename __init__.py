@@ -8,8 +8,6 @@ http://www.astrochasqui.com/projects/astro/share/q2Data.tar.gz and must
 be placed in the q2/Data folder.
 """
 
-import matplotlib
-matplotlib.use('Agg', warn=False, force=False)
 from .config import *
 from .star import *
 from . import moog, specpars, errors, abundances, gce
@@ -24,6 +22,12 @@ __email__ = 'iramirez@tacomacc.edu'
 
 logging.basicConfig(level=logging.ERROR)
 logger.setLevel('WARNING')
-_moog = moog_is_available()
 _data = data_are_available()
 logger.setLevel('ERROR')
+
+
+def __getattr__(name):
+    #MOOG is looked for on first use, not at import time
+    if name == '_moog':
+        return moog_is_available()
+    raise AttributeError("module 'q2' has no attribute '"+name+"'")
@@ -1,19 +1,30 @@
 from . import moog
-from .star import Star
+from .star import Star, get_model_atmospheres
 import numpy as np
 import datetime
 import logging
-from scipy import interpolate
 import os
 from .config import *
-from .tools import read_csv
+from .tools import read_csv, match_lines
+from .results import open_sink, silenced
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+#number of stars whose model atmospheres get_all prepares at once
+MODEL_CHUNK = 256
+
 
 def get_all(Data, output_file, species_ids=None, reference=None, grid='odfnew',
-        errors=False, nlte=True):
+        errors=False, nlte=True, quiet=False):
+    """Calculates the abundances of species_ids for every star in Data and
+    writes them to output_file, one star at a time as they are done.
+
+    output_file can be a CSV file, a JSON-lines file (.jsonl), an sqlite
+    database (.sqlite or .db), or a sink object (see q2.results). Missing
+    abundances are left empty (None). If quiet is True, the per-star
+    abundance tables are not printed.
+    """
     print('------------------------------------------------------')
     print('Initializing ...')
     start_time = datetime.datetime.now()
@@ -32,8 +43,6 @@ def get_all(Data, output_file, species_ids=None, reference=None, grid='odfnew',
         ref.get_model_atmosphere(grid)
     else:
         ref = None
-    fout = open(output_file, 'w')
-    header = 'id'
     if species_ids == None:
         species_codes = sorted(set(Data.lines['species']))
         species_ids = getsp_ids(species_codes)
@@ -41,96 +50,31 @@ def get_all(Data, output_file, species_ids=None, reference=None, grid='odfnew',
         print('Lines found for the following species: '+\
               ','.join(species_ids))
         print('')
+    columns, formats = ['id'], {}
     for species_id in species_ids:
-        header += ','+species_id+',e_'+species_id+',n_'+species_id
+        names = [species_id, 'e_'+species_id, 'n_'+species_id]
         if reference:
-            header += ',['+species_id+'],e_['+species_id+\
-                      '],n_['+species_id+']'
+            names += ['['+species_id+']', 'e_['+species_id+']',
+                      'n_['+species_id+']']
         if errors:
-            header += ',err_'+species_id
-    fout.write(header + '\n')
-    for star_id in Data.star_data['id']:
-        line = star_id
-        print('')
-        print('*'*len(star_id))
-        print(star_id)
-        print('*'*len(star_id))
-        s = Star(star_id)
-        try:
-            s.get_data_from(Data)
-            if hasattr(s, 'feh_model'):
-                s.feh = getattr(s, 'feh_model')
-            s.get_model_atmosphere(grid)
-        except:
-            print('No data available')
-            logger.warning('Could not get all the necessary data')
-            line += ','*(len(species_ids)*2)
-            if reference:
-                line += ','*(len(species_ids)*2)
-            fout.write(line+'\n')
-            continue
-
-        print('Using [Fe/H] = {0:6.3f} for the model atmosphere'.format(s.feh))
-        get_one(s, species_ids, ref, errors=errors, nlte=nlte)
-        for species_id in species_ids:
-            print('\n'+species_id+'\n'+'-'*len(species_id))
-            if not hasattr(s, species_id):
-                print('No data available')
-                logger.warning('There are no '+species_id+' abundances '+\
-                               'for this star')
-                line += ',,'
-                if reference:
-                    line += ',,'
-                continue
-            mab = np.mean(getattr(s, species_id)['ab'])
-            sab = np.std(getattr(s, species_id)['ab'])
-            nab = len(getattr(s, species_id)['ab'])
-            print("ABS = {0:6.3f} +/- {1:6.3f} , n = {2:.0f}".\
-                  format(mab, sab, nab))
-            line += ',{0:.3f},{1:.3f},{2:.0f}'.format(mab, sab, nab)
-            if reference:
-                da = getattr(s, species_id)['difab']
-                da = np.array(da, dtype=np.float) #convert None to np.nan
-                mda = np.ma.masked_array(da, np.isnan(da))
-                mdifab = np.mean(mda)
-                sdifab = np.std(mda)
-                ndifab = mda.count()
-                print("DIF = {0:6.3f} +/- {1:6.3f} , n = {2:.0f}".\
-                      format(mdifab, sdifab, ndifab))
-                line += ',{0:.3f},{1:.3f},{2:.0f}'.\
-                        format(mdifab, sdifab, ndifab)
-                if errors:
-                    print("ERR = {0:5.3f} (DIF)".\
-                          format(getattr(s, species_id)['err_difab']))
-                    line += ',{0:.3f}'.\
-                            format(getattr(s, species_id)['err_difab'])
-            else:
-                mdifab = 0
-                if errors:
-                    print("ERR = {0:5.3f} (ABS)".\
-                          format(getattr(s, species_id)['err_ab']))
-                    line += ',{0:.3f}'.\
-                            format(getattr(s, species_id)['err_ab'])
-            print('')
-            llhd1 = 'Wavelength   ABS    RES '
-            llhd2 = '----------  ----- ------'
-            if reference:
-                llhd1 += '   DIF    RES '
-                llhd2 += '  -----  -----'
-            print(llhd1+'\n'+llhd2)
-            for wi, ab, difab in \
-                zip(getattr(s, species_id)['ww'],
-                    getattr(s, species_id)['ab'],
-                    getattr(s, species_id)['difab']):
-                if reference and difab != None:
-                    print("{0:10.4f} {1:6.3f} {2:6.3f} {3:6.3f} {4:6.3f}".\
-                          format(wi, ab, ab-mab, difab, difab-mdifab))
-                else:
-                    print("{0:10.4f} {1:6.3f} {2:6.3f}".\
-                          format(wi, ab, ab-mab))
-
-        fout.write(line+'\n')
-    fout.close()
+            names += ['err_'+species_id]
+        for name in names:
+            formats[name] = '{:.0f}' if name.startswith('n_') else '{:.3f}'
+        columns += names
+    sink = open_sink(output_file)
+    sink.start(columns, formats)
+    star_ids = list(Data.star_data['id'])
+    for start in range(0, len(star_ids), MODEL_CHUNK):
+        #model atmospheres of a chunk of stars at once (see
+        #star.get_model_atmospheres)
+        chunk = star_ids[start:start+MODEL_CHUNK]
+        models = get_model_atmospheres(Data, grid, chunk)
+        for star_id in chunk:
+            with silenced(quiet):
+                record = _star_record(star_id, Data, species_ids, ref, grid,
+                                      models, errors, nlte)
+            sink.write(record)
+    sink.close()
     print('')
     print('------------------------------------------------------')
     end_time = datetime.datetime.now()
@@ -144,6 +88,90 @@ def get_all(Data, output_file, species_ids=None, reference=None, grid='odfnew',
     print('')
 
 
+def _star_record(star_id, Data, species_ids, ref, grid, models,
+                 errors=False, nlte=True):
+    """Output record of get_all for one star."""
+    record = OrderedDict([('id', star_id)])
+    print('')
+    print('*'*len(star_id))
+    print(star_id)
+    print('*'*len(star_id))
+    s = Star(star_id)
+    try:
+        s.get_data_from(Data)
+        if hasattr(s, 'feh_model'):
+            s.feh = getattr(s, 'feh_model')
+        if models.get(star_id) is not None:
+            s.model_atmosphere = models.pop(star_id)
+            s.model_atmosphere_grid = grid
+        else:
+            s.get_model_atmosphere(grid)
+    except:
+        print('No data available')
+        logger.warning('Could not get all the necessary data')
+        return record
+
+    print('Using [Fe/H] = {0:6.3f} for the model atmosphere'.format(s.feh))
+    get_one(s, species_ids, ref, errors=errors, nlte=nlte)
+    for species_id in species_ids:
+        print('\n'+species_id+'\n'+'-'*len(species_id))
+        if not hasattr(s, species_id):
+            print('No data available')
+            logger.warning('There are no '+species_id+' abundances '+\
+                           'for this star')
+            continue
+        mab = np.mean(getattr(s, species_id)['ab'])
+        sab = np.std(getattr(s, species_id)['ab'])
+        nab = len(getattr(s, species_id)['ab'])
+        print("ABS = {0:6.3f} +/- {1:6.3f} , n = {2:.0f}".\
+              format(mab, sab, nab))
+        record[species_id] = mab
+        record['e_'+species_id] = sab
+        record['n_'+species_id] = nab
+        if ref:
+            da = getattr(s, species_id)['difab']
+            da = np.asarray(da, dtype=float)
+            mda = np.ma.masked_array(da, np.isnan(da))
+            mdifab = np.mean(mda)
+            sdifab = np.std(mda)
+            ndifab = mda.count()
+            print("DIF = {0:6.3f} +/- {1:6.3f} , n = {2:.0f}".\
+                  format(mdifab, sdifab, ndifab))
+            if ndifab > 0:
+                record['['+species_id+']'] = mdifab
+                record['e_['+species_id+']'] = sdifab
+            record['n_['+species_id+']'] = ndifab
+            if errors:
+                print("ERR = {0:5.3f} (DIF)".\
+                      format(getattr(s, species_id)['err_difab']))
+                record['err_'+species_id] = \
+                    getattr(s, species_id)['err_difab']
+        else:
+            mdifab = 0
+            if errors:
+                print("ERR = {0:5.3f} (ABS)".\
+                      format(getattr(s, species_id)['err_ab']))
+                record['err_'+species_id] = getattr(s, species_id)['err_ab']
+        print('')
+        llhd1 = 'Wavelength   ABS    RES '
+        llhd2 = '----------  ----- ------'
+        if ref:
+            llhd1 += '   DIF    RES '
+            llhd2 += '  -----  -----'
+        print(llhd1+'\n'+llhd2)
+        for wi, ab, difab in \
+            zip(getattr(s, species_id)['ww'],
+                getattr(s, species_id)['ab'],
+                getattr(s, species_id)['difab']):
+            if ref and np.isfinite(difab):
+                print("{0:10.4f} {1:6.3f} {2:6.3f} {3:6.3f} {4:6.3f}".\
+                      format(wi, ab, ab-mab, difab, difab-mdifab))
+            else:
+                print("{0:10.4f} {1:6.3f} {2:6.3f}".\
+                      format(wi, ab, ab-mab))
+    return record
+
+
 def get_one(Star, species_ids=None, Ref=object, silent=True, errors=False, nlte=True):
     logger.info('Working on: '+Star.name)
     if species_ids == None:
@@ -154,6 +182,15 @@ def get_one(Star, species_ids=None, Ref=object, silent=True, errors=False, nlte=
             print('Lines found for the following species: '+\
                   ','.join(species_ids))
             print('')
+    #a single MOOG run for all species (hfs species are run one by one)
+    species_list = sorted(set([sp_map[species_id] for species_id
+                               in species_ids if species_id in sp_map]))
+    x = moog.abfind_multi(Star, species_list)
+    xr = {}
+    if hasattr(Ref, 'name') and Star.name != Ref.name:
+        missing = [sp_map[species_id] for species_id in species_ids
+                   if species_id in sp_map and not hasattr(Ref, species_id)]
+        xr = moog.reference_abundances(Ref, missing)
     for species_id in species_ids:
         species = getsp(species_id)
         if not silent:
@@ -162,8 +199,10 @@ def get_one(Star, species_ids=None, Ref=object, silent=True, errors=False, nlte=
             logger.warning('Not doing calculations for: '+species_id)
             continue
         logger.info('Working on: '+species_id)
-        ab = moog.abfind(Star, species, species_id)
+        ab = x[species]
         if ab:
+            #own copy: several species_ids may share a species
+            ab = dict((col, np.copy(val)) for col, val in ab.items())
             setattr(Star, species_id, ab)
         else:            
             logger.warning('Did not calculate '+species_id+' abundances')
@@ -192,7 +231,13 @@ def get_one(Star, species_ids=None, Ref=object, silent=True, errors=False, nlte=
                 Ref = Star
             if not hasattr(Ref, species_id):
                 logger.info('Calculating reference star abundances: '+Ref.name)
-                setattr(Ref, species_id, moog.abfind(Ref, species, species_id))
+                if species not in xr:
+                    xr.update(moog.reference_abundances(Ref, [species]))
+                ab_ref = xr[species]
+                if ab_ref:
+                    ab_ref = dict((col, np.copy(val))
+                                  for col, val in ab_ref.items())
+                setattr(Ref, species_id, ab_ref)
                 
 
                 if (species_id == 'OI') & nlte:
@@ -214,31 +259,21 @@ def get_one(Star, species_ids=None, Ref=object, silent=True, errors=False, nlte=
                 logger.info('Reference star has '+species_id+\
                             ' abundances computed already: '+Ref.name)
 
-            ws = getattr(Star, species_id)['ww']
-            wr = getattr(Ref, species_id)['ww']
-            ww = np.intersect1d(ws, wr)
-            k  = [i for i, w in zip(range(len(ws)), ws) if w in ww]
-            kr = [i for i, w in zip(range(len(wr)), wr) if w in ww]
-            a = getattr(Star, species_id)['ab'][k] - \
-                getattr(Ref, species_id)['ab'][kr]
-            ax, ix = [], 0
-            for wx in ws:
-                if wx in ww:
-                    ax.append(a[ix])
-                    ix += 1
-                else:
-                    ax.append(None)
-            getattr(Star, species_id)['difab'] = ax
+            getattr(Star, species_id)['difab'] = \
+                match_lines(getattr(Star, species_id)['ww'],
+                            getattr(Ref, species_id)['ww'],
+                            getattr(Star, species_id)['ab'],
+                            getattr(Ref, species_id)['ab'])[2]
             getattr(Star, species_id)['ref'] = Ref.name
 
         if not silent:
             ab = getattr(Star, species_id)['ab']
             difab = getattr(Star, species_id)['difab']
 
-            aa = np.array(ab, dtype=np.float) #convert None to np.nan
+            aa = np.asarray(ab, dtype=float)
             maa = np.ma.masked_array(aa, np.isnan(aa))
 
-            da = np.array(difab, dtype=np.float) #convert None to np.nan
+            da = np.asarray(difab, dtype=float)
             mda = np.ma.masked_array(da, np.isnan(da))
 
             print("A({0})  = {1:6.3f} +/- {2:5.3f} (# of lines = {3})".\
@@ -270,6 +305,7 @@ def error(Star_in, species_id, Ref=object, silent=True):
     try:
         Ref.model_atmosphere_grid
         dab = getattr(Star_in, species_id)['difab']
+        dab = dab[np.isfinite(dab)] #lines not measured in Ref are NaN
         l2l_sct = np.std(dab)/np.sqrt(max([len(dab),2])-1)
         abx = 'difab'
     except:
@@ -286,11 +322,11 @@ def error(Star_in, species_id, Ref=object, silent=True):
             s.teff += s.err_teff
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            ap = np.mean(getattr(s, species_id)[abx])
+            ap = np.nanmean(getattr(s, species_id)[abx])
             s.teff -= 2*s.err_teff
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            am = np.mean(getattr(s, species_id)[abx])
+            am = np.nanmean(getattr(s, species_id)[abx])
             a_teff = abs(ap-am)/2.
             s.teff += s.err_teff
         else:
@@ -303,11 +339,11 @@ def error(Star_in, species_id, Ref=object, silent=True):
             s.logg += s.err_logg
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            ap = np.mean(getattr(s, species_id)[abx])
+            ap = np.nanmean(getattr(s, species_id)[abx])
             s.logg -= 2*s.err_logg
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            am = np.mean(getattr(s, species_id)[abx])
+            am = np.nanmean(getattr(s, species_id)[abx])
             a_logg = abs(ap-am)/2.
             s.logg += s.err_logg
         else:
@@ -320,11 +356,11 @@ def error(Star_in, species_id, Ref=object, silent=True):
             s.feh += s.err_feh
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            ap = np.mean(getattr(s, species_id)[abx])
+            ap = np.nanmean(getattr(s, species_id)[abx])
             s.feh -= 2*s.err_feh
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            am = np.mean(getattr(s, species_id)[abx])
+            am = np.nanmean(getattr(s, species_id)[abx])
             a_feh = abs(ap-am)/2.
             s.feh += s.err_feh
         else:
@@ -337,11 +373,11 @@ def error(Star_in, species_id, Ref=object, silent=True):
             s.vt += s.err_vt
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            ap = np.mean(getattr(s, species_id)[abx])
+            ap = np.nanmean(getattr(s, species_id)[abx])
             s.vt -= 2*s.err_vt
             s.get_model_atmosphere(s.model_atmosphere_grid)
             get_one(s, [species_id], Ref=Ref)
-            am = np.mean(getattr(s, species_id)[abx])
+            am = np.nanmean(getattr(s, species_id)[abx])
             a_vt = abs(ap-am)/2.
             s.vt += s.err_vt
         else:
@@ -499,6 +535,7 @@ def gettc(species_id):
 
 
 def nlte_triplet(teff, logg, feh, ao, silent=True):
+    from scipy import interpolate
     if feh >= 0.4:
         feh = 0.4
     grid = read_csv(os.path.join(OTHER_PATH ,'nlte_triplet.csv'))
@@ -1,6 +1,7 @@
 import os
+import sys
+import shutil
 import logging
-import matplotlib.pyplot as plt
 
 logger = logging.getLogger(__name__)
 
@@ -13,28 +14,51 @@ MODATM_PATH     = os.path.join(path, 'ModelAtmospheres')
 ISOCHRONES_PATH = os.path.join(path, 'Isochrones')
 OTHER_PATH      = os.path.join(path, 'Other')
 
-plt.rc("font", family='serif', serif='Ubuntu', monospace='Ubuntu Mono', \
-               size=14)
-plt.rc("axes", labelsize=15, titlesize=12)
-plt.rc("xtick", top=True, direction='in', labelsize=14)
-plt.rc("xtick.major", size=8, width=1)
-plt.rc("ytick", right=True, direction='in', labelsize=14)
-plt.rc("ytick.major", size=8, width=1)
-plt.rc("lines", markersize=10, markeredgewidth=2)
-plt.rc("lines", linewidth=3)
+#root of the temporary MOOG run directories; point Q2_SCRATCH to a
+#memory-backed file system (e.g., /dev/shm) to keep them off the disk
+SCRATCH_PATH    = os.environ.get('Q2_SCRATCH', '.q2')
+
+_pyplot = None
+_moog_available = None
+
+def pyplot():
+    """Returns matplotlib.pyplot, importing it the first time a figure is
+    needed. The Agg backend is selected (unless pyplot was already in use)
+    and the q2 plot style is applied only once.
+    """
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib
+        if 'matplotlib.pyplot' not in sys.modules:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        plt.rc("font", family='serif', serif='Ubuntu',
+                       monospace='Ubuntu Mono', size=14)
+        plt.rc("axes", labelsize=15, titlesize=12)
+        plt.rc("xtick", top=True, direction='in', labelsize=14)
+        plt.rc("xtick.major", size=8, width=1)
+        plt.rc("ytick", right=True, direction='in', labelsize=14)
+        plt.rc("ytick.major", size=8, width=1)
+        plt.rc("lines", markersize=10, markeredgewidth=2)
+        plt.rc("lines", linewidth=3)
+        _pyplot = plt
+    return _pyplot
 
 def moog_is_available():
     """You should be able to run MOOGSILENT from the command line in order
     to use the MOOG features included in q2. This function checks if
     MOOG is available on your system. If False, you wont be able to
-    connect q2 to MOOG and many things will fail.
+    connect q2 to MOOG and many things will fail. The check is done once
+    (on the first MOOG run) and cached.
     """
-    if os.system('which MOOGSILENT >/dev/null'):
-        logger.warning("MOOGSILENT is not available")
-        return False
-    else:
-        logger.info("MOOGSILENT is available")
-        return True
+    global _moog_available
+    if _moog_available is None:
+        _moog_available = shutil.which('MOOGSILENT') is not None
+        if _moog_available:
+            logger.info("MOOGSILENT is available")
+        else:
+            logger.error("MOOGSILENT is not available")
+    return _moog_available
 
 def data_are_available():
     """q2 needs data files with model atmosphere and isochrone grids.
@@ -1,131 +1,47 @@
 import numpy as np
 from numpy import matrix
+from concurrent.futures import ThreadPoolExecutor
 from .star import Star
-from . import specpars
+from . import specpars, moog
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def error_one(Star_in, SolvePars, Ref=object):
+def error_one(Star_in, SolvePars, Ref=object, sensitivity=None):
+    """Errors of the spectroscopic parameters of Star_in (sets sp_err).
+
+    sensitivity is the 3x3 matrix of derivatives of slope_ep, slope_rew,
+    and FeI-FeII (rows) with respect to teff, vt, and logg (columns). If
+    not given, the one left by the Newton solver (Star_in.sp_jacobian) is
+    used when it belongs to the current parameters; otherwise it is
+    computed here with six more iron_stats runs.
+
+    Each perturbed iron_stats run is made on its own copy of Star_in;
+    with SolvePars.error_workers > 1 the runs of each round are made
+    concurrently.
+    """
 
-    s = Star()
-    s.__dict__ = Star_in.__dict__.copy()
     try:
         Ref.get_model_atmosphere(SolvePars.grid)
         logger.info('Relative abundances')
     except:
         logger.info('Absolute abundances')
-
-    dteff = 20
-    dvt = 0.02
-    dlogg = 0.02
-
-    s.teff = s.teff + dteff
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx1  = s.iron_stats['slope_ep']
-    efx1 = s.iron_stats['err_slope_ep']
-    gx1  = s.iron_stats['slope_rew']
-    egx1 = s.iron_stats['err_slope_rew']
-    hx1  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx1 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.teff = s.teff - 2*dteff
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx2  = s.iron_stats['slope_ep']
-    efx2 = s.iron_stats['err_slope_ep']
-    gx2  = s.iron_stats['slope_rew']
-    egx2 = s.iron_stats['err_slope_rew']
-    hx2  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx2 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.teff = s.teff + dteff
-    dfx = 1e0*(fx2-fx1)/(2*dteff)
-    efx = 1e0*(efx1+efx2)/2
-    dgx = 1e0*(gx2-gx1)/(2*dteff)
-    egx = 1e0*(egx1+egx2)/2
-    dhx = 1e0*(hx2-hx1)/(2*dteff)
-    ehx = 1e0*(ehx1+ehx2)/2
-    dfdt, dgdt, dhdt = dfx, dgx, dhx
-    eft, egt, eht = efx, egx, ehx
-
-    s.vt = s.vt + dvt
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx1  = s.iron_stats['slope_ep']
-    efx1 = s.iron_stats['err_slope_ep']
-    gx1  = s.iron_stats['slope_rew']
-    egx1 = s.iron_stats['err_slope_rew']
-    hx1  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx1 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.vt = s.vt - 2*dvt
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx2  = s.iron_stats['slope_ep']
-    efx2 = s.iron_stats['err_slope_ep']
-    gx2  = s.iron_stats['slope_rew']
-    egx2 = s.iron_stats['err_slope_rew']
-    hx2  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx2 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.vt = s.vt + dvt
-    dfx = 1e0*(fx2-fx1)/(2*dvt)
-    efx = 1e0*(efx1+efx2)/2
-    dgx = 1e0*(gx2-gx1)/(2*dvt)
-    egx = 1e0*(egx1+egx2)/2
-    dhx = 1e0*(hx2-hx1)/(2*dvt)
-    ehx = 1e0*(ehx1+ehx2)/2
-    dfdv, dgdv, dhdv = dfx, dgx, dhx
-    efv, egv, ehv = efx, egx, ehx
-
-    s.logg = s.logg + dlogg
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx1  = s.iron_stats['slope_ep']
-    efx1 = s.iron_stats['err_slope_ep']
-    gx1  = s.iron_stats['slope_rew']
-    egx1 = s.iron_stats['err_slope_rew']
-    hx1  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx1 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.logg = s.logg - 2*dlogg
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    fx2  = s.iron_stats['slope_ep']
-    efx2 = s.iron_stats['err_slope_ep']
-    gx2  = s.iron_stats['slope_rew']
-    egx2 = s.iron_stats['err_slope_rew']
-    hx2  = s.iron_stats['afe1'] - s.iron_stats['afe2']
-    ehx2 = np.sqrt(s.iron_stats['err_afe1']**2+
-                   s.iron_stats['err_afe2']**2)/\
-           np.sqrt(s.iron_stats['nfe1']+s.iron_stats['nfe2'])
-    s.logg = s.logg + dlogg
-    dfx = 1e0*(fx2-fx1)/(2*dlogg)
-    efx = 1e0*(efx1+efx2)/2
-    dgx = 1e0*(gx2-gx1)/(2*dlogg)
-    egx = 1e0*(egx1+egx2)/2
-    dhx = 1e0*(hx2-hx1)/(2*dlogg)
-    ehx = 1e0*(ehx1+ehx2)/2
-    dfdg, dgdg, dhdg = dfx, dgx, dhx
-    efg, egg, ehg = efx, egx, ehx
-    
-    d = matrix( [ [dfdt, dfdv, dfdg],
-                  [dgdt, dgdv, dgdg],
-                  [dhdt, dhdv, dhdg] ] )
+    if hasattr(Ref, 'name') and not hasattr(Ref, 'fe1'):
+        #computed here so that the perturbation runs only read Ref
+        fe = moog.reference_abundances(Ref, [26.0, 26.1])
+        Ref.fe1, Ref.fe2 = fe[26.0], fe[26.1]
+
+    if sensitivity is None:
+        sensitivity = _cached_jacobian(Star_in)
+    if sensitivity is None:
+        d, s0, s1, s2 = _sensitivity(Star_in, SolvePars, Ref)
+    else:
+        #sign does not matter: only squares of the inverse are used below
+        d = matrix(sensitivity)
+        s0, s1, s2 = specpars.iron_residuals(Star_in)[1]
     di = d.I
 
-    s0 = np.mean([eft,efv,efg])
-    s1 = np.mean([egt,egv,egg])
-    s2 = np.mean([eht,ehv,ehg])
-
     eteff = np.sqrt ( (s0*di[0, 0])**2 +
                       (s1*di[0, 1])**2 +
                       (s2*di[0, 2])**2  )
@@ -138,39 +54,83 @@ def error_one(Star_in, SolvePars, Ref=object):
                       (s1*di[2, 1])**2 +
                       (s2*di[2, 2])**2  )
 
-    s.teff = s.teff + eteff
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    ap = s.iron_stats['afe']
-    s.teff = s.teff - 2*eteff
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    am = s.iron_stats['afe']
-    s.teff = s.teff + eteff
-    eat = (ap-am)/2
-
-    s.logg = s.logg + elogg
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    ap = s.iron_stats['afe']
-    s.logg = s.logg - 2*elogg
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    am = s.iron_stats['afe']
-    s.logg = s.logg + elogg
-    eag = (ap-am)/2
-
-    s.vt = s.vt + evt
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    ap = s.iron_stats['afe']
-    s.vt = s.vt - 2*evt
-    s.get_model_atmosphere(SolvePars.grid)
-    specpars.iron_stats(s, Ref=Ref)
-    am = s.iron_stats['afe']
-    s.vt = s.vt + evt
-    eav = (ap-am)/2
+    x = _perturbed_iron_stats(Star_in, SolvePars, Ref,
+                              [('teff', eteff), ('teff', -eteff),
+                               ('logg', elogg), ('logg', -elogg),
+                               ('vt', evt), ('vt', -evt)])
+    eat = (x[0]['afe']-x[1]['afe'])/2
+    eag = (x[2]['afe']-x[3]['afe'])/2
+    eav = (x[4]['afe']-x[5]['afe'])/2
 
     ea = np.sqrt(eat**2+eag**2+eav**2+s2**2)
 
     Star_in.sp_err = {'teff': int(eteff), 'logg': elogg, 'afe': ea, 'vt': evt}
+
+
+def _cached_jacobian(Star):
+    if getattr(Star, 'sp_jacobian', None) is None:
+        return None
+    if getattr(Star, 'sp_jacobian_at', None) != \
+       (Star.teff, Star.vt, Star.logg, Star.feh):
+        return None
+    return Star.sp_jacobian
+
+
+def _sensitivity(Star_in, SolvePars, Ref):
+    """Central-difference sensitivity matrix and mean errors of slope_ep,
+    slope_rew, and FeI-FeII.
+    """
+    dteff = 20
+    dvt = 0.02
+    dlogg = 0.02
+
+    x = _perturbed_iron_stats(Star_in, SolvePars, Ref,
+                              [('teff', dteff), ('teff', -dteff),
+                               ('vt', dvt), ('vt', -dvt),
+                               ('logg', dlogg), ('logg', -dlogg)])
+    dx = [dteff, dvt, dlogg]
+    d = np.zeros((3, 3))
+    err = np.zeros((3, 3))
+    for k in range(3):
+        x1, x2 = x[2*k], x[2*k+1]
+        for j, (f1, f2) in enumerate(zip(_fgh(x1), _fgh(x2))):
+            d[j, k] = 1e0*(f2[0]-f1[0])/(2*dx[k])
+            err[j, k] = 1e0*(f1[1]+f2[1])/2
+    d = matrix(d)
+
+    s0 = np.mean(err[0])
+    s1 = np.mean(err[1])
+    s2 = np.mean(err[2])
+    return d, s0, s1, s2
+
+
+def _fgh(x):
+    """(value, error) of slope_ep, slope_rew, and FeI-FeII from the
+    iron_stats dictionary x.
+    """
+    h = x['afe1'] - x['afe2']
+    eh = np.sqrt(x['err_afe1']**2+x['err_afe2']**2)/\
+         np.sqrt(x['nfe1']+x['nfe2'])
+    return [(x['slope_ep'], x['err_slope_ep']),
+            (x['slope_rew'], x['err_slope_rew']),
+            (h, eh)]
+
+
+def _perturbed_iron_stats(Star_in, SolvePars, Ref, perturbations):
+    """Returns the iron_stats of Star_in with each (parameter, delta) of
+    perturbations applied, each on a copy of Star_in.
+    """
+    def run(perturbation):
+        par, delta = perturbation
+        s = Star()
+        s.__dict__ = Star_in.__dict__.copy()
+        setattr(s, par, getattr(s, par) + delta)
+        s.get_model_atmosphere(SolvePars.grid)
+        specpars.iron_stats(s, Ref=Ref)
+        return s.iron_stats
+
+    workers = getattr(SolvePars, 'error_workers', 1)
+    if workers > 1:
+        with ThreadPoolExecutor(min(workers, len(perturbations))) as pool:
+            return list(pool.map(run, perturbations))
+    return [run(perturbation) for perturbation in perturbations]
@@ -1,7 +1,5 @@
 import numpy as np
 import q2
-import pdb
-import matplotlib.pyplot as plt
 
 b_map_linear = {
 # slope correction factor and error [dex/Gyr]
@@ -136,7 +134,7 @@ def correct(Star, age, species_ids=None, method='linear', Ref=None, Ref_age=0.0,
         # get abundances:
         Tc = np.append(Tc, q2.abundances.gettc(species_id))
         species_difab = np.array(getattr(Star, species_id)['difab'])
-        species_difab = species_difab[species_difab != np.array(None)]  #remove Nones from where ref star was unavailable
+        species_difab = species_difab[np.isfinite(species_difab)]  #remove NaNs from where ref star was unavailable
         abund = np.append(abund, np.mean(species_difab))
         if errors:
             err = np.append(err, getattr(Star, species_id)['err_difab'])
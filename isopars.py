@@ -1,9 +1,6 @@
 import sqlite3
 import numpy as np
 import logging
-import matplotlib.pyplot as plt
-from scipy.integrate import simps
-from scipy.interpolate import griddata
 from .config import *
 import os
 import datetime
@@ -58,6 +55,7 @@ def pdf(pdf_x, ips, prob, par, smooth_window_len, silent=False):
     possible (otherwise returns two non-smoothed PDFs), as well as a stats
     dictionary with mean, std, most probable value, etc.
     '''
+    from scipy.integrate import simps
     dx = 0.5*(pdf_x[1] - pdf_x[0])
     pdf_y = []
     for x in pdf_x:
@@ -95,6 +93,8 @@ def pdf(pdf_x, ips, prob, par, smooth_window_len, silent=False):
     return pdf_y, pdf_y_smooth, stats
 
 def get_stats(pdf_x, pdf_y_smooth):
+    from scipy.integrate import simps
+    from scipy.interpolate import griddata
     stats = {}
     stats['most_probable'] = \
       np.mean(np.array(pdf_x)[pdf_y_smooth == max(pdf_y_smooth)])
@@ -271,6 +271,8 @@ def solve_one(Star, SolvePars, PlotPars=PlotPars(), isochrone_points=None, silen
     if not PlotPars.make_figures:
         return
 
+    plt = pyplot()
+
     if not os.path.exists(PlotPars.directory) and PlotPars.directory != "":
         os.mkdir(PlotPars.directory)
 
@@ -1,30 +1,164 @@
-import matplotlib.pyplot as plt
 import logging
-from . import tools
 import os
 from .config import *
-from scipy.integrate import simps
 import numpy as np
-from scipy.interpolate import griddata
 
 logger = logging.getLogger(__name__)
 
 
+MODEL_COLUMNS = ['RHOX', 'T', 'P', 'XNE', 'ABROSS']
+#order of the columns in the packed (binary) model atmosphere grids
+PACKED_COLUMNS = MODEL_COLUMNS + ['TAU']
+
+_packed_grids = {}
+_node_cache = {}
+
+
+def grid_path(grid):
+    """Directory where the model files of a given grid are found."""
+    if grid == 'marcs':
+        return os.path.join(MODATM_PATH, 'marcs')
+    else:
+        return os.path.join(MODATM_PATH, 'kurucz')
+
+
+def grid_nodes(grid):
+    """Returns the available teff, logg, and feh values of a model grid
+    (None if the grid is not available).
+    """
+    avail_teff = list(range(3500, 7501, 250))
+    avail_logg = [i*0.5 for i in range(11)]
+    if grid == 'over':
+        avail_feh = [+1.0,+0.5,+0.2,+0.1,+0.0,-0.1,-0.2,-0.3,-0.5,
+                     -1.0,-1.5,-2.0,-2.5,-3.0,-3.5,-4.0,-4.5,-5.0]
+    elif grid == 'nover':
+        avail_feh = [+0.5,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5]
+    elif grid == 'odfnew':
+        avail_feh = [+0.5,+0.2,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5]
+    elif grid == 'aodfnew':
+        avail_feh = [+0.5,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5,-4.0]
+    elif grid == 'marcs':
+        avail_feh = [+0.5,+0.25,+0.0,-0.25,-0.5,-0.75,
+                     -1.0,-1.5,-2.0,-2.5,-3.0,-4.0]
+        avail_teff = [3500, 3600, 3700, 3800, 3900]
+        [avail_teff.append(t) for t in range(4000, 7001, 250)]
+    else:
+        return None
+    return avail_teff, avail_logg, avail_feh
+
+
+def pack_grid(grid):
+    """Packs all model files of a grid into a single binary file
+
+    The result is one array of shape (nteff, nlogg, nfeh, ndepth, 6) with
+    the columns in PACKED_COLUMNS (tauRoss included), saved as <grid>.npy
+    next to the model files. Missing models (and depths beyond the last
+    layer of a model) are NaN. Once the file exists, get_from_file reads
+    models from it (memory-mapped) instead of from the ASCII files.
+    This needs to be done only once per grid.
+    """
+    nodes = grid_nodes(grid)
+    if nodes is None:
+        logger.error('The type of model requested is not available.')
+        return None
+    models = {}
+    for i, teff in enumerate(nodes[0]):
+        for j, logg in enumerate(nodes[1]):
+            for k, feh in enumerate(nodes[2]):
+                x, tau = read_model_file(teff, logg, feh, grid)
+                if x is not None:
+                    models[(i, j, k)] = (x, tau)
+    if not models:
+        logger.error('No '+grid+' model files found.')
+        return None
+    nd = max([len(tau) for x, tau in models.values()])
+    packed = np.full((len(nodes[0]), len(nodes[1]), len(nodes[2]), nd,
+                      len(PACKED_COLUMNS)), np.nan)
+    for (i, j, k), (x, tau) in models.items():
+        for c, col in enumerate(PACKED_COLUMNS[:-1]):
+            packed[i, j, k, :len(tau), c] = x[col]
+        packed[i, j, k, :len(tau), -1] = tau
+    file_name = os.path.join(grid_path(grid), grid+'.npy')
+    np.save(file_name, packed)
+    _packed_grids.pop(grid, None)
+    logger.info(str(len(models))+' models packed into '+file_name)
+    return file_name
+
+
+def load_packed_grid(grid):
+    """Returns the memory-mapped packed grid (None if it does not exist)."""
+    if grid not in _packed_grids:
+        file_name = os.path.join(grid_path(grid), grid+'.npy')
+        if os.path.exists(file_name):
+            _packed_grids[grid] = np.load(file_name, mmap_mode='r')
+            logger.info('Using packed model grid: '+file_name)
+        else:
+            _packed_grids[grid] = None
+    return _packed_grids[grid]
+
+
 def get_from_file(teff, logg, feh, grid):
     """Extracts a Kurucz or MARCS model atmosphere
 
     If model file does not exist, the program returns None, None.
     Output is model, tauRoss. The latter is necessary for proper
-    model interpolation.
+    model interpolation. Models are taken from the packed grid file
+    if one was created with pack_grid. Models found are cached, so each
+    grid node is read (and its tauRoss scale calculated) only once.
+    """
+    key = (grid, round(float(teff), 6), round(float(logg), 6),
+           round(float(feh), 6))
+    if key not in _node_cache:
+        x, tau = read_node(teff, logg, feh, grid)
+        if x is None:
+            return None, None
+        _node_cache[key] = x, tau
+    x, tau = _node_cache[key]
+    return dict((col, x[col].copy()) for col in x), tau.copy()
+
+
+def read_node(teff, logg, feh, grid):
+    """Same as get_from_file but without the cache."""
+    packed = load_packed_grid(grid)
+    if packed is None:
+        return read_model_file(teff, logg, feh, grid)
+
+    nodes = grid_nodes(grid)
+    try:
+        i = [abs(t-teff) < 1e-6 for t in nodes[0]].index(True)
+        j = [abs(g-logg) < 1e-6 for g in nodes[1]].index(True)
+        k = [abs(f-feh) < 1e-6 for f in nodes[2]].index(True)
+    except ValueError:
+        i = None
+    if i is None or np.isnan(packed[i, j, k, 0, 0]):
+        logger.warning('Model not found in packed grid: '+str(teff)+', '+\
+                       str(logg)+', '+str(feh)+', '+grid)
+        return None, None
+    logger.info('Model found in packed grid: '+str(teff)+', '+\
+                str(logg)+', '+str(feh)+', '+grid)
+
+    node = np.array(packed[i, j, k])
+    node = node[~np.isnan(node[:, 0])]
+    x = {}
+    for c, col in enumerate(PACKED_COLUMNS[:-1]):
+        x[col] = node[:, c]
+    return x, node[:, -1]
+
+
+def read_model_file(teff, logg, feh, grid):
+    """Reads a Kurucz or MARCS model atmosphere from its ASCII file
+
+    If model file does not exist, the program returns None, None.
+    Output is model, tauRoss.
     """
 
     # location of model files
-    if grid == 'marcs':
-        path = os.path.join(MODATM_PATH, 'marcs')
-    else:
-        path = os.path.join(MODATM_PATH, 'kurucz')
+    path = grid_path(grid)
 
-    # determine filename from input parameters
+    # determine filename from input parameters (teff of nodes are integers,
+    # but may come as floats, e.g., 5750.0, from the model cache or CSV)
+    if float(teff) == round(float(teff)):
+        teff = int(round(float(teff)))
     logg = float(logg)
     g = 'g'+str(logg).replace('.', '')
     feh = float(feh)
@@ -53,17 +187,44 @@ def get_from_file(teff, logg, feh, grid):
     for key in keys:
         x[key] = np.array(x[key])
 
-    # calculate tauRoss scale
-    tau0 = x['RHOX'][0]*x['ABROSS'][0]
-    xdtau, ydtau, tau = [], [], []
-    for rhox, abross in zip(x['RHOX'], x['ABROSS']):
-        xdtau.append(rhox)
-        ydtau.append(abross)
-        tau.append(simps(ydtau, xdtau))
-    tau[0] = tau0
-    tau = np.array(tau)
+    return x, tau_ross(x['RHOX'], x['ABROSS'])
 
-    return x, tau
+
+def tau_ross(rhox, abross):
+    """Calculates the tauRoss scale of a model atmosphere
+
+    tau[i] is the Simpson integral of abross over rhox from the top of the
+    atmosphere down to layer i, as given by scipy's simps (even='avg') on
+    each prefix of the arrays, but all layers are done in one cumulative
+    pass. tau[0] is rhox[0]*abross[0].
+    """
+    x, y = np.asarray(rhox, dtype=float), np.asarray(abross, dtype=float)
+    n = len(x)
+    tau = np.empty(n)
+    tau[0] = x[0]*y[0]
+    if n < 2:
+        return tau
+    h = np.diff(x)
+    # Simpson integrals over (x[i], x[i+1], x[i+2]) for every i
+    h0, h1 = h[:-1], h[1:]
+    hsum, hprod, h0divh1 = h0+h1, h0*h1, h0/h1
+    pairs = hsum/6.0*(y[:-2]*(2-1.0/h0divh1) + y[1:-1]*hsum*hsum/hprod +
+                      y[2:]*(2-h0divh1))
+    # cumulative sums of the pairs starting at even and odd layers
+    c0 = np.concatenate(([0.], np.cumsum(pairs[0::2])))
+    c1 = np.concatenate(([0.], np.cumsum(pairs[1::2])))
+    # odd number of points: plain composite Simpson
+    k = np.arange(2, n, 2)
+    tau[k] = c0[k//2]
+    # even number of points: average of Simpson on the first n-1 points
+    # plus a trapezoid on the last interval and a trapezoid on the first
+    # interval plus Simpson on the last n-1 points
+    k = np.arange(1, n, 2)
+    m = (k+1)//2
+    first = 0.5*h[0]*(y[1]+y[0])
+    last = 0.5*h[k-1]*(y[k]+y[k-1])
+    tau[k] = (c0[m-1]+c1[m-1])/2.0 + (last+first)/2.0
+    return tau
 
 
 def interpolate(teff, logg, feh, grid):
@@ -73,39 +234,46 @@ def interpolate(teff, logg, feh, grid):
     Returns None if for some reason the program cannot interpolate.
     """
 
-    model, tau = get_from_file(teff, logg, feh, grid)
-    if model != None:
-        return model
-
-    avail_teff = range(3500, 7501, 250)
-    avail_logg = [i*0.5 for i in range(11)]
-    avail_feh_over = [+1.0,+0.5,+0.2,+0.1,+0.0,-0.1,-0.2,-0.3,-0.5,
-                      -1.0,-1.5,-2.0,-2.5,-3.0,-3.5,-4.0,-4.5,-5.0]
-    avail_feh_nover = [+0.5,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5]
-    avail_feh_odfnew = [+0.5,+0.2,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5]
-    avail_feh_aodfnew = [+0.5,+0.0,-0.5,-1.0,-1.5,-2.0,-2.5,-4.0]
-    avail_feh_marcs = [+0.5,+0.25,+0.0,-0.25,-0.5,-0.75,
-                       -1.0,-1.5,-2.0,-2.5,-3.0,-4.0]
-    if grid == 'over':
-        avail_feh = avail_feh_over
-    if grid == 'nover':
-        avail_feh = avail_feh_nover
-    if grid == 'odfnew':
-        avail_feh = avail_feh_odfnew
-    if grid == 'aodfnew':
-        avail_feh = avail_feh_aodfnew
-    if grid == 'marcs':
-        avail_feh = avail_feh_marcs
-        avail_teff = [3500, 3600, 3700, 3800, 3900]
-        [avail_teff.append(t) for t in range(4000, 7001, 250)]
-
-    try:
-        avail_feh
-    except NameError:
+    nodes = grid_nodes(grid)
+    if nodes is None:
         logger.error('The type of model requested is not available.')
         return None
 
+    if is_node(teff, logg, feh, nodes):
+        model, tau = get_from_file(teff, logg, feh, grid)
+        if model is not None:
+            return model
+
     logger.info('Interpolating in the '+grid+' model grid:')
+    cell = find_cell(teff, logg, feh, nodes)
+    if cell is None:
+        return None
+
+    logger.info('Reading available models:')
+    corners = load_cell(cell, grid)
+    if corners is None:
+        return None
+
+    model = blend(corners, cell, teff, logg, feh)
+
+    logger.info('Model interpolation was successful.')
+    return model
+
+
+def is_node(teff, logg, feh, nodes):
+    """True if (teff, logg, feh) is one of the nodes of a model grid."""
+    return any([abs(t-teff) < 1e-6 for t in nodes[0]]) and \
+           any([abs(g-logg) < 1e-6 for g in nodes[1]]) and \
+           any([abs(f-feh) < 1e-6 for f in nodes[2]])
+
+
+def find_cell(teff, logg, feh, nodes):
+    """Finds the teff, logg, and feh grid values that bracket a model
+
+    nodes are the available values (see grid_nodes). Returns tx, gx, fx
+    (pairs of grid values) or None if the model is outside of the grid.
+    """
+    avail_teff, avail_logg, avail_feh = nodes
 
     #dt = [abs(t-teff) for t in avail_teff]
     #dt_idx = sorted(range(len(dt)), key=lambda k: dt[k])
@@ -147,53 +315,150 @@ def interpolate(teff, logg, feh, grid):
         logger.error('Cannot interpolate in [Fe/H].')
         return None
 
-    logger.info('Reading available models:')
-    T0G0F0, tau000 = get_from_file(tx[0], gx[0], fx[0], grid)
-    T0G0F1, tau001 = get_from_file(tx[0], gx[0], fx[1], grid)
-    T0G1F0, tau010 = get_from_file(tx[0], gx[1], fx[0], grid)
-    T0G1F1, tau011 = get_from_file(tx[0], gx[1], fx[1], grid)
-    T1G0F0, tau100 = get_from_file(tx[1], gx[0], fx[0], grid)
-    T1G0F1, tau101 = get_from_file(tx[1], gx[0], fx[1], grid)
-    T1G1F0, tau110 = get_from_file(tx[1], gx[1], fx[0], grid)
-    T1G1F1, tau111 = get_from_file(tx[1], gx[1], fx[1], grid)
-
-    tau_min = max(tau000[0], tau001[0], tau010[0], tau011[0],
-                  tau100[0], tau101[0], tau110[0], tau111[0] )
-    n = len(tau000) - 1
-    tau_max = min(tau000[n], tau001[n], tau010[n], tau011[n],
-                  tau100[n], tau101[n], tau110[n], tau111[n] )
-    tau = tau000[(tau000 >= tau_min) & (tau000 <= tau_max)]
-    tau_new = griddata(np.array(range(len(tau))), tau,
-                       np.array(range(n+1))*np.array(float(len(tau)-1))/n)
-    #for name in T0G0F0.dtype.names:
-    for name in T0G0F0.keys():
-        T0G0F0[name] = griddata(tau000, T0G0F0[name], tau_new)
-        T0G0F1[name] = griddata(tau001, T0G0F1[name], tau_new)
-        T0G1F0[name] = griddata(tau010, T0G1F0[name], tau_new)
-        T0G1F1[name] = griddata(tau011, T0G1F1[name], tau_new)
-        T1G0F0[name] = griddata(tau100, T1G0F0[name], tau_new)
-        T1G0F1[name] = griddata(tau101, T1G0F1[name], tau_new)
-        T1G1F0[name] = griddata(tau110, T1G1F0[name], tau_new)
-        T1G1F1[name] = griddata(tau111, T1G1F1[name], tau_new)
-        T0G0F0[name][0] = T0G0F0[name][1]*0.999
-        T0G0F1[name][0] = T0G0F1[name][1]*0.999
-        T0G1F0[name][0] = T0G1F0[name][1]*0.999
-        T0G1F1[name][0] = T0G1F1[name][1]*0.999
-        T1G0F0[name][0] = T1G0F0[name][1]*0.999
-        T1G0F1[name][0] = T1G0F1[name][1]*0.999
-        T1G1F0[name][0] = T1G1F0[name][1]*0.999
-        T1G1F1[name][0] = T1G1F1[name][1]*0.999
+    return tuple(tx), tuple(gx), tuple(fx)
+
+
+def load_cell(cell, grid):
+    """Reads the eight corner models of a grid cell and puts them on a
+    common tauRoss scale
+
+    Returns an array of shape (2, 2, 2, ndepth, 5), indexed as
+    [teff, logg, feh, depth, column] with the columns in MODEL_COLUMNS,
+    or None if a corner model is missing.
+    """
+    tx, gx, fx = cell
+    models, taus = [], []
+    for t in tx:
+        for g in gx:
+            for f in fx:
+                model, tau = get_from_file(t, g, f, grid)
+                if model is None:
+                    logger.error('Cannot interpolate: missing corner model.')
+                    return None
+                models.append(np.column_stack([model[col] for col in
+                                               MODEL_COLUMNS]))
+                taus.append(tau)
+
+    n = len(taus[0]) - 1
+    tau_min = max([tau[0] for tau in taus])
+    tau_max = min([tau[n] for tau in taus])
+    tau = taus[0][(taus[0] >= tau_min) & (taus[0] <= tau_max)]
+    tau_new = resample(np.arange(len(tau)), tau[:, None],
+                       np.arange(n+1)*float(len(tau)-1)/n)[:, 0]
+    corners = np.empty((8, n+1, len(MODEL_COLUMNS)))
+    for i in range(8):
+        corners[i] = resample(taus[i], models[i], tau_new)
+    corners[:, 0] = corners[:, 1]*0.999
+    return corners.reshape((2, 2, 2, n+1, len(MODEL_COLUMNS)))
+
 
+def resample(x, y, x_new):
+    """Linear interpolation of the columns of y (one row per x value) to
+    x_new, with the same arithmetic as the 1-D
+    scipy.interpolate.griddata/interp1d used before. Like interp1d, x
+    is sorted first: tauRoss scales from tau_ross are not monotonic in
+    the top layers.
+    """
+    order = np.argsort(x, kind='mergesort')
+    x, y = x[order], y[order]
+    idx = np.clip(np.searchsorted(x, x_new), 1, len(x)-1)
+    lo, hi = idx-1, idx
+    slope = (y[hi] - y[lo]) / (x[hi] - x[lo])[:, None]
+    return slope*(x_new - x[lo])[:, None] + y[lo]
+
+
+def blend(corners, cell, teff, logg, feh):
+    """Trilinear interpolation of the corner models from load_cell to
+    (teff, logg, feh); first in feh, then logg, then teff.
+    """
+    m = blend_many(corners, cell, [teff], [logg], [feh])[0]
+    model = {}
+    for c, col in enumerate(MODEL_COLUMNS):
+        model[col] = m[:, c].copy()
+    return model
+
+
+def blend_many(corners, cell, teffs, loggs, fehs):
+    """Same as blend for many (teff, logg, feh) points of the same cell.
+    Returns an array of shape (npoints, ndepth, 5).
+    """
+    tx, gx, fx = cell
+    m = corners[None]
     #feh-interpolate
-    T0G0 = tools.linterp(T0G0F0, T0G0F1, fx[0], fx[1], feh)
-    T0G1 = tools.linterp(T0G1F0, T0G1F1, fx[0], fx[1], feh)
-    T1G0 = tools.linterp(T1G0F0, T1G0F1, fx[0], fx[1], feh)
-    T1G1 = tools.linterp(T1G1F0, T1G1F1, fx[0], fx[1], feh)
+    s = 1.*(np.asarray(fehs, dtype=float)-fx[0])/(fx[1]-fx[0])
+    s = s[:, None, None, None, None]
+    m = (1.-s)*m[:, :, :, 0] + s*m[:, :, :, 1]
     #logg-interpolate
-    T0 = tools.linterp(T0G0, T0G1, gx[0], gx[1], logg)
-    T1 = tools.linterp(T1G0, T1G1, gx[0], gx[1], logg)
+    s = 1.*(np.asarray(loggs, dtype=float)-gx[0])/(gx[1]-gx[0])
+    s = s[:, None, None, None]
+    m = (1.-s)*m[:, :, 0] + s*m[:, :, 1]
     #teff-interpolate
-    model = tools.linterp(T0, T1, tx[0], tx[1], teff)
+    s = 1.*(np.asarray(teffs, dtype=float)-tx[0])/(tx[1]-tx[0])
+    s = s[:, None, None]
+    m = (1.-s)*m[:, 0] + s*m[:, 1]
+    return m
 
-    logger.info('Model interpolation was successful.')
-    return model
+
+def interpolate_many(teffs, loggs, fehs, grid):
+    """Interpolates many model atmospheres at once
+
+    Same as calling interpolate for each (teff, logg, feh), but models
+    are grouped by grid cell, so the corners of each cell are read and
+    put on a common tauRoss scale only once, and all models of a cell
+    are interpolated together. Returns the models stacked in an array
+    of shape (nmodels, ndepth, 5), columns as in MODEL_COLUMNS. Models
+    with fewer layers are padded with NaN, and models that interpolate
+    cannot make are all NaN; use model_dict to get a model like the ones
+    returned by interpolate.
+    """
+    nodes = grid_nodes(grid)
+    if nodes is None:
+        logger.error('The type of model requested is not available.')
+        return stack_models([None]*len(teffs))
+
+    models = [None]*len(teffs)
+    cells = {}
+    for i, (teff, logg, feh) in enumerate(zip(teffs, loggs, fehs)):
+        if is_node(teff, logg, feh, nodes):
+            models[i], tau = get_from_file(teff, logg, feh, grid)
+            if models[i] is not None:
+                continue
+        cell = find_cell(teff, logg, feh, nodes)
+        if cell is not None:
+            cells.setdefault(cell, []).append(i)
+
+    logger.info('Interpolating '+str(len(teffs))+' models in '+\
+                str(len(cells))+' '+grid+' grid cells')
+    for cell, idx in cells.items():
+        corners = load_cell(cell, grid)
+        if corners is None:
+            continue
+        m = blend_many(corners, cell, [teffs[i] for i in idx],
+                       [loggs[i] for i in idx], [fehs[i] for i in idx])
+        for k, i in enumerate(idx):
+            models[i] = m[k]
+    return stack_models(models)
+
+
+def stack_models(models):
+    """Stacks models (dicts or (ndepth, 5) arrays, or None) into a single
+    NaN-padded array, as returned by interpolate_many.
+    """
+    models = [np.column_stack([m[col] for col in MODEL_COLUMNS])
+              if isinstance(m, dict) else m for m in models]
+    nd = max([len(m) for m in models if m is not None] or [0])
+    x = np.full((len(models), nd, len(MODEL_COLUMNS)), np.nan)
+    for i, m in enumerate(models):
+        if m is not None:
+            x[i, :len(m)] = m
+    return x
+
+
+def model_dict(x):
+    """Model (a dict like the ones returned by interpolate) from one of the
+    models stacked by interpolate_many; None if it is all NaN.
+    """
+    x = x[~np.isnan(x[:, 0])]
+    if len(x) == 0:
+        return None
+    return dict((col, x[:, c].copy()) for c, col in enumerate(MODEL_COLUMNS))
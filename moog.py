@@ -1,12 +1,121 @@
 import numpy as np
 import os
 import logging
-import pdb
-import multiprocessing as mp
+import shutil
+import subprocess
+import tempfile
+import threading
+import hashlib
+import pickle
+import sqlite3
+from collections import OrderedDict
 from .config import *
 
 logger = logging.getLogger(__name__)
 
+#every MOOG call runs in its own temporary directory created inside
+#scratch_dir (SCRATCH_PATH from config by default, e.g. /dev/shm)
+scratch_dir = SCRATCH_PATH
+
+
+class AbfindCache:
+    """Keeps abfind results so that MOOG is not run again for a point
+    that was already calculated.
+
+    Results are keyed on the model atmosphere (grid, teff, logg, [Fe/H]),
+    vt, species, and a hash of the line data (wavelength, species, ep, gf,
+    and ew). Up to maxsize of them are kept in memory (least recently used
+    ones are dropped first). If path is set, results are also stored in
+    that sqlite database, so they survive across sessions.
+    Example: moog.abfind_cache.path = 'abfind_cache.sql3'
+    """
+    def __init__(self, maxsize=1024, path=None):
+        self.enabled = True
+        self.maxsize = maxsize
+        self.path = path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, Star, species):
+        if hasattr(Star, 'feh_model'):
+            feh = Star.feh_model
+        else:
+            feh = Star.feh
+        idx = np.where(np.logical_and(Star.linelist['species'] == species,
+                                      has_ew(Star.linelist['ew'])))[0]
+        h = hashlib.sha1()
+        for col in ['wavelength', 'species', 'ep', 'gf', 'ew']:
+            h.update(np.asarray(Star.linelist[col][idx], dtype=float).\
+                     tobytes())
+        return '|'.join([str(getattr(Star, 'model_atmosphere_grid', None)),
+                         repr(Star.teff), repr(Star.logg), repr(feh),
+                         repr(Star.vt), repr(species), h.hexdigest()])
+
+    def get(self, key):
+        """Returns a copy of the cached result, or None if not found."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            x = self._memory.get(key)
+            if x is not None:
+                self._memory.move_to_end(key)
+        if x is None and self.path and os.path.exists(self.path):
+            conn = sqlite3.connect(self.path, timeout=60)
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS abfind '+
+                             '(key TEXT PRIMARY KEY, x BLOB)')
+                row = conn.execute('SELECT x FROM abfind WHERE key = ?',
+                                   (key,)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                x = pickle.loads(row[0])
+                self._remember(key, x)
+        if x is None:
+            return None
+        logger.info('abfind result found in cache')
+        return dict((col, np.copy(val)) for col, val in x.items())
+
+    def put(self, key, x):
+        if not self.enabled or not x:
+            return
+        x = dict((col, np.copy(val)) for col, val in x.items())
+        self._remember(key, x)
+        if self.path:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60)
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS abfind '+
+                                 '(key TEXT PRIMARY KEY, x BLOB)')
+                    conn.execute('INSERT OR REPLACE INTO abfind VALUES (?, ?)',
+                                 (key, sqlite3.Binary(pickle.dumps(x, 2))))
+            finally:
+                conn.close()
+
+    def clear(self):
+        """Empties the in-memory cache (the database file is kept)."""
+        with self._lock:
+            self._memory.clear()
+
+    def _remember(self, key, x):
+        with self._lock:
+            self._memory[key] = x
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+abfind_cache = AbfindCache()
+
+#abundances of reference stars (see reference_abundances), computed only
+#once per session for a given grid, set of parameters, and line list. To
+#keep them across sessions and processes, give it a database file, e.g.
+#moog.reference_cache.path = 'reference_cache.sql3' (keys do not include
+#the MOOG version or the model grid files: delete it if those change)
+reference_cache = AbfindCache(maxsize=64)
+
 
 class Driver:
     """Set the options for your MOOG driver."""
@@ -69,20 +178,14 @@ def create_model_in(Star, file_name='model.in', ni_override=0.0):
         feh = Star.feh_model
     else:
         feh = Star.feh
-    
-    current = mp.current_process()
-    mod_id = current.pid  # generate an ID number for this calculation
-    head_file = 'head'+str(mod_id)+'.tmp'
-    body_file = 'body'+str(mod_id)+'.tmp'
-    tail_file = 'tail'+str(mod_id)+'.tmp'
-    with open(head_file, 'w') as f:
+    
+    with open(file_name, 'w') as f:
         f.write('KURUCZ\n')
         f.write('TEFF='+str(Star.teff)+',LOGG='+str(Star.logg)+
                 ',[FE/H]='+str(feh)+','+Star.model_atmosphere_grid+'\n')
         nd = len(Star.model_atmosphere['T'])
         f.write('ND=       '+str(nd)+'\n')
 
-    with open(body_file, 'w') as f:
         for idx in range(nd):
             f.write("{0:.8E} {1:.1F} {2:.3E} {3:.3E} {4:.3E}\n".format(\
                     Star.model_atmosphere['RHOX'][idx],\
@@ -92,7 +195,6 @@ def create_model_in(Star, file_name='model.in', ni_override=0.0):
                     Star.model_atmosphere['ABROSS'][idx])
                    )
 
-    with open(tail_file, 'w') as f:
         f.write('%5.2F\n' %Star.vt)
         if Star.model_atmosphere_grid != 'marcs':
             path = os.path.join(MODATM_PATH, 'kurucz')
@@ -120,8 +222,8 @@ def create_model_in(Star, file_name='model.in', ni_override=0.0):
             else:
                 abund = 12.+np.log10(np.power(10, float(line[3:9]))/0.92040)+ \
                         feh
-            if species=='28' and ni_override != 0.0:
-                abund = ni_override
+            if species=='28' and ni_override != 0.0:
+                abund = ni_override
             abund = str('%5.2F' %abund)
             f.write(species+' '+abund+'\n')
             line = fabund.readline()
@@ -134,25 +236,31 @@ def create_model_in(Star, file_name='model.in', ni_override=0.0):
         f.write('  10108.0 60808.0\n')
         f.write('  6.1     7.1     8.1   12.1  22.1  26.1\n')
 
-    file_list = [head_file, body_file, tail_file]
-    with open(file_name, 'w') as outfile:
-        for one_file in file_list:
-            with open(one_file) as infile:
-                outfile.write(infile.read())
-    for one_file in file_list:
-        os.unlink(one_file)
-    logger.info('Moog infile model atmosphere created: '+file_name+' with calculation ID '+str(mod_id))
+    logger.info('Moog infile model atmosphere created: '+file_name)
+
+
+def has_ew(ew):
+    """True for lines with a measured EW (empty cells are NaN or None)."""
+    return np.isfinite(np.asarray(ew, dtype=float))
 
 
 def create_lines_in(Star, species=0, file_name='lines.in'):
-    """Creates a line list file for MOOG"""
-    if species > 0:
+    """Creates a line list file for MOOG
+
+    species can also be a list of species; their lines are then written
+    grouped by species, in the order given, as required by abfind.
+    """
+    ok = has_ew(Star.linelist['ew'])
+    if np.ndim(species) > 0:
+        idx = np.concatenate([np.where(np.logical_and(\
+                  Star.linelist['species'] == sp, ok))[0]\
+                  for sp in species])
+    elif species > 0:
         idx = np.where(np.logical_and(Star.linelist['species'] == species,\
-                                      np.not_equal(Star.linelist['ew'],\
-                                                   None)))[0]
+                                      ok))[0]
     else:
         #species = 0 means all species
-        idx = np.where(np.not_equal(Star.linelist['ew'], None))[0]
+        idx = np.where(ok)[0]
 
     nlines = len(idx)
     if nlines == 0:
@@ -185,17 +293,49 @@ def create_lines_in(Star, species=0, file_name='lines.in'):
     return True
 
 
+def make_run_dir():
+    """Creates a unique directory inside scratch_dir for one MOOG run.
+    Driver, model, line list, and output files all live there, so MOOG
+    calls from different threads or processes never share files.
+    """
+    if not os.path.exists(scratch_dir):
+        try:
+            os.makedirs(scratch_dir)
+        except OSError: #created by a concurrent caller
+            pass
+    return tempfile.mkdtemp(prefix='moog', dir=scratch_dir)
+
+
+def run_moog(run_dir, batch_file='batch.par'):
+    """Runs MOOGSILENT inside run_dir using the driver file batch_file.
+    MOOG output to the terminal goes to moog.log in the same directory.
+    Raises OSError if MOOGSILENT is not in the PATH.
+    """
+    if not moog_is_available():
+        raise OSError("MOOGSILENT is not available (not found in the PATH)")
+    with open(os.path.join(run_dir, 'moog.log'), 'w') as log:
+        p = subprocess.Popen('MOOGSILENT', cwd=run_dir, shell=True,
+                             stdin=subprocess.PIPE, stdout=log,
+                             stderr=subprocess.STDOUT)
+        p.communicate((batch_file+'\n').encode())
+
+
 def abfind(Star, species, species_id):
     """Runs MOOG with abfind driver for a given Star and species
 
     Star is a star object; must have all attributes in place
     species could be 26.0 for Fe I, for example
     species_id is a string that will become a new attribute for the Star object
-    ** returns a dict object with abundance information
+    ** returns a dict object with abundance information
     Example: abfind(s, 26.1, 'fe2')
     s.fe2 #shows result from abfind
     MD is the moog driver object
     """
+    key = abfind_cache.key(Star, species)
+    x = abfind_cache.get(key)
+    if x is not None:
+        return x
+
     k = Star.linelist['species'] == species
     negs = [wx for wx in Star.linelist['wavelength'][k] if wx < 0]
     if len(negs) == 0:
@@ -203,28 +343,135 @@ def abfind(Star, species, species_id):
     else:
         MD = Driver() #hfs
         MD.hfs_species = str(round(species))
-    if not os.path.exists('.q2'):
-        os.mkdir('.q2')
-    
-    current = mp.current_process()
-    run_id = current.pid # generate an ID number for this calculation
-
-    MD.standard_out = os.path.join('.q2', 'moog'+str(run_id)+'.std')
-    MD.summary_out = os.path.join('.q2', 'moog'+str(run_id)+'.sum')
-    MD.model_in = os.path.join('.q2', 'model'+str(run_id)+'.in')
-    MD.lines_in = os.path.join('.q2', 'lines'+str(run_id)+'.in')
-    batchfile = 'batch'+str(run_id)+'.par'
-    MD.create_file(file_name=batchfile)
-
-    create_model_in(Star, file_name=MD.model_in)
-    found_lines = create_lines_in(Star, species=species, file_name=MD.lines_in)
-    if not found_lines:
-        logger.warning('Did not run abfind (no lines found)')
-        return False
-    logfile = os.path.join('.q2', 'moog'+str(run_id)+'.log')
-    os.system('echo '+batchfile+' | MOOGSILENT > '+logfile+' 2>&1')
+    run_dir = make_run_dir()
+    try:
+        MD.create_file(file_name=os.path.join(run_dir, 'batch.par'))
 
-    f = open(MD.summary_out, 'r')
+        create_model_in(Star, file_name=os.path.join(run_dir, MD.model_in))
+        found_lines = create_lines_in(Star, species=species,
+                                      file_name=os.path.join(run_dir,
+                                                             MD.lines_in))
+        if not found_lines:
+            logger.warning('Did not run abfind (no lines found)')
+            return False
+        run_moog(run_dir)
+
+        blocks = read_abfind_summary(os.path.join(run_dir, MD.summary_out))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    #with multiple iterations (molecules) the last block is the final one
+    x = blocks[-1][1]
+    abfind_cache.put(key, x)
+    logger.info('Successfully ran abfind in '+run_dir)
+    return x
+
+
+def abfind_multi(Star, species_list):
+    """Runs MOOG with abfind driver once for several species of a Star
+
+    The lines of all species in species_list go into a single line list
+    and a single MOOG run; the summary is split back into one dict per
+    species, each identical to what abfind would return for it.
+    ** returns a dict object with species as keys (False for species
+    without lines)
+    Example: x = abfind_multi(s, [26.0, 26.1])
+    x[26.1] #shows Fe II result, same as abfind(s, 26.1, 'fe2')
+    Species with hyperfine structure (negative wavelengths) need the
+    blends driver and are run separately through abfind.
+    """
+    x, keys = {}, {}
+    group = []
+    for species in species_list:
+        k = Star.linelist['species'] == species
+        if any(Star.linelist['wavelength'][k] < 0):
+            x[species] = abfind(Star, species, str(species))
+            continue
+        keys[species] = abfind_cache.key(Star, species)
+        x[species] = abfind_cache.get(keys[species])
+        if x[species] is None:
+            group.append(species)
+    if len(group) == 1:
+        x[group[0]] = abfind(Star, group[0], str(group[0]))
+    if len(group) <= 1:
+        return x
+
+    MD = Driver()
+    run_dir = make_run_dir()
+    try:
+        MD.create_file(file_name=os.path.join(run_dir, 'batch.par'))
+
+        create_model_in(Star, file_name=os.path.join(run_dir, MD.model_in))
+        found_lines = create_lines_in(Star, species=group,
+                                      file_name=os.path.join(run_dir,
+                                                             MD.lines_in))
+        if not found_lines:
+            logger.warning('Did not run abfind (no lines found)')
+            for species in group:
+                x[species] = False
+            return x
+        run_moog(run_dir)
+
+        blocks = read_abfind_summary(os.path.join(run_dir, MD.summary_out))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    ww = Star.linelist['wavelength']
+    for species in group:
+        x[species] = False
+    for block_species, block in blocks:
+        if block_species is None:
+            #older MOOG versions: identify the block by its first line
+            if len(block['ww']) == 0:
+                continue
+            k = np.argmin(abs(ww - block['ww'][0]))
+            block_species = Star.linelist['species'][k]
+        for species in group:
+            if abs(species - block_species) < 0.01:
+                #later blocks (molecule iterations) replace earlier ones
+                x[species] = block
+    for species in group:
+        abfind_cache.put(keys[species], x[species])
+    logger.info('Successfully ran abfind for '+\
+                ','.join([str(sp) for sp in group])+' in '+run_dir)
+    return x
+
+
+def reference_abundances(Ref, species_list):
+    """abfind_multi for a reference star, going through reference_cache
+
+    Species already in reference_cache (this session or, if its path is
+    set, an earlier session or another process) need no MOOG run.
+    Ref must have its model atmosphere.
+    ** returns a dict object with species as keys, like abfind_multi
+    """
+    x, keys, todo = {}, {}, []
+    for species in species_list:
+        keys[species] = abfind_cache.key(Ref, species)
+        x[species] = reference_cache.get(keys[species])
+        if x[species] is None:
+            todo.append(species)
+        else:
+            #e.g., for the reference star when it is in the list of stars
+            abfind_cache.put(keys[species], x[species])
+    if todo:
+        logger.info('Calculating reference star abundances: '+Ref.name)
+        y = abfind_multi(Ref, todo)
+        for species in todo:
+            x[species] = y[species]
+            reference_cache.put(keys[species], x[species])
+    return x
+
+
+def read_abfind_summary(file_name):
+    """Reads the summary_out file of a MOOG abfind run
+
+    Returns a list with one (species, x) tuple per block of lines found
+    in the file, where x is the dict object returned by abfind. species
+    comes from the 'ID' column (None for MOOG versions without it).
+    """
+    blocks = []
+    f = open(file_name, 'r')
     line, stop = '', False
     while line[0:10] != 'wavelength':
         line = f.readline()
@@ -233,7 +480,8 @@ def abfind(Star, species, species_id):
     else:
         moogjul2014 = False
     while not stop: #looping required for multiple iterations (molecules)
-        ww, ep, ew, rew, ab, difab = [], [], [], [], [], []
+        ww, ep, ew, rew, ab = [], [], [], [], []
+        species = None
         while line:
             line = f.readline()
             if line[0:7] == 'average': break
@@ -242,6 +490,7 @@ def abfind(Star, species, species_id):
                 continue
             ww.append(float(linesplit[0]))
             if moogjul2014: #MOOGJUL2014 adds a new column 'ID' to moog.sum
+                species = round(float(linesplit[1]), 1)
                 ep.append(float(linesplit[2]))
                 ew.append(float(linesplit[4]))
                 rew.append(float(linesplit[5]))
@@ -251,7 +500,10 @@ def abfind(Star, species, species_id):
                 ew.append(float(linesplit[3]))
                 rew.append(float(linesplit[4]))
                 ab.append(float(linesplit[5]))
-            difab.append(None)
+        x = {'ww': np.array(ww), 'ep': np.array(ep), 'ew': np.array(ew),\
+        'rew': np.array(rew), 'ab': np.array(ab),\
+        'difab': np.full(len(ab), np.nan)}
+        blocks.append((species, x))
         while line: #to break out of multiple iterations loop if done
             line = f.readline()
             if line[0:10] == 'wavelength':
@@ -259,20 +511,7 @@ def abfind(Star, species, species_id):
                 break
             stop = True
     f.close()
-    os.unlink(MD.file_name)
-    os.unlink(MD.model_in)
-    os.unlink(MD.lines_in)
-    os.unlink(MD.summary_out)
-    os.unlink(MD.standard_out)
-    os.unlink(logfile)
-    #os.unlink(batchfile)
-    if os.path.isfile('fort.99'):
-        os.unlink('fort.99')
-
-    x = {'ww': np.array(ww), 'ep': np.array(ep), 'ew': np.array(ew),\
-    'rew': np.array(rew), 'ab': np.array(ab), 'difab': np.array(difab)}
-    logger.info('Successfully ran abfind with ID '+str(run_id))
-    return x
+    return blocks
 
 
 def cog(Star, species, cog_id):
@@ -288,38 +527,38 @@ def cog(Star, species, cog_id):
     k = Star.linelist['species'] == species
     #negs = [wx for wx in Star.linelist['wavelength'][k] if wx < 0]
     MD = Driver(mode='cog')
-    MD.create_file()
-    create_model_in(Star)
-    found_lines = create_lines_in(Star, species=species)
-    if not found_lines:
-        logger.warning('Did not run cog (no lines found)')
-        return False
-    os.system('MOOGSILENT > moog.log 2>&1')
+    run_dir = make_run_dir()
+    try:
+        MD.create_file(file_name=os.path.join(run_dir, 'batch.par'))
+        create_model_in(Star, file_name=os.path.join(run_dir, MD.model_in))
+        found_lines = create_lines_in(Star, species=species,
+                                      file_name=os.path.join(run_dir,
+                                                             MD.lines_in))
+        if not found_lines:
+            logger.warning('Did not run cog (no lines found)')
+            return False
+        run_moog(run_dir)
 
-    f = open(MD.summary_out, 'r')
-    line = f.readline()
-    cog_obj = {}
-    while line:
+        f = open(os.path.join(run_dir, MD.summary_out), 'r')
         line = f.readline()
-        if line.startswith('wavelength'):
-            npt = int(line.split('=')[5]) #number of cog points
-            #wavelength = round(float(line.split('=')[1].split()[0]), 1)
-            wavelength = float(line.split('=')[1].split()[0])
+        cog_obj = {}
+        while line:
             line = f.readline()
-            x, y = [], []
-            for i in range(int(np.ceil(npt/5.))):
+            if line.startswith('wavelength'):
+                npt = int(line.split('=')[5]) #number of cog points
+                #wavelength = round(float(line.split('=')[1].split()[0]), 1)
+                wavelength = float(line.split('=')[1].split()[0])
                 line = f.readline()
-                for j in range(len(line.split())/2):
-                    x.append(float(line.split()[2*j].replace(',', '')))
-                    y.append(float(line.split()[2*j+1]))
-            cog_obj[wavelength] = {'loggf': np.array(x), 'logrw': np.array(y)}
-    f.close()
-
-    os.unlink(MD.file_name)
-    os.unlink(MD.model_in)
-    os.unlink(MD.lines_in)
-    os.unlink(MD.summary_out)
-    os.unlink(MD.standard_out)
-    os.unlink('moog.log')
+                x, y = [], []
+                for i in range(int(np.ceil(npt/5.))):
+                    line = f.readline()
+                    for j in range(len(line.split())/2):
+                        x.append(float(line.split()[2*j].replace(',', '')))
+                        y.append(float(line.split()[2*j+1]))
+                cog_obj[wavelength] = {'loggf': np.array(x),
+                                       'logrw': np.array(y)}
+        f.close()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
 
     setattr(Star, cog_id, cog_obj)
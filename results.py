@@ -0,0 +1,138 @@
+"""Results sinks used by specpars.solve_all and abundances.get_all.
+
+The results of each star are passed to a sink as a record (an OrderedDict
+of column name -> value) and are written out and flushed as soon as the
+star is done, so other jobs can read them while the run goes on. The
+backend is chosen from the output file extension (see open_sink); sink
+objects can also be passed directly instead of a file name.
+"""
+import os
+import json
+import sqlite3
+import logging
+from contextlib import contextmanager, redirect_stdout
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CSVSink:
+    """Writes records as rows of a CSV file. formats maps columns to a
+    format string (e.g., '{:5.3f}') or to a function returning a string;
+    missing values (None) are left as empty cells.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def start(self, columns, formats=None):
+        self.columns = columns
+        self.formats = formats or {}
+        self.f = open(self.file_name, 'w')
+        self.f.write(','.join(columns)+'\n')
+        self.f.flush()
+
+    def write(self, record):
+        cells = []
+        for column in self.columns:
+            x = record.get(column)
+            fmt = self.formats.get(column, '{}')
+            if x is None:
+                cells.append('')
+            elif callable(fmt):
+                cells.append(fmt(x))
+            else:
+                cells.append(fmt.format(x))
+        self.f.write(','.join(cells)+'\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class JSONLinesSink:
+    """Writes every record as one JSON object per line."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def start(self, columns, formats=None):
+        self.columns = columns
+        self.f = open(self.file_name, 'w')
+
+    def write(self, record):
+        self.f.write(json.dumps(native(record))+'\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class SQLiteSink:
+    """Writes records as rows of a table (default 'results') of an sqlite
+    database; an existing table of the same name is replaced. Each record
+    is committed right away.
+    """
+    def __init__(self, file_name, table='results'):
+        self.file_name = file_name
+        self.table = table
+
+    def start(self, columns, formats=None):
+        self.columns = columns
+        self.db = sqlite3.connect(self.file_name)
+        names = ','.join(_quote(column) for column in columns)
+        self.db.execute('DROP TABLE IF EXISTS '+_quote(self.table))
+        self.db.execute('CREATE TABLE '+_quote(self.table)+' ('+names+')')
+        self.db.commit()
+        self._insert = 'INSERT INTO '+_quote(self.table)+' ('+names+\
+                       ') VALUES ('+','.join(['?']*len(columns))+')'
+
+    def write(self, record):
+        record = native(record)
+        self.db.execute(self._insert,
+                        [record.get(column) for column in self.columns])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def open_sink(output):
+    """Returns a sink for output: a sink object is returned as is; file
+    names (or paths) ending in .jsonl or .json give a JSONLinesSink,
+    .sqlite, .sqlite3, or .db an SQLiteSink, and anything else a CSVSink.
+    """
+    if not isinstance(output, (str, os.PathLike)):
+        return output
+    output = os.fspath(output)
+    ext = os.path.splitext(output)[1].lower()
+    if ext in ['.jsonl', '.json']:
+        return JSONLinesSink(output)
+    if ext in ['.sqlite', '.sqlite3', '.db']:
+        return SQLiteSink(output)
+    return CSVSink(output)
+
+
+def native(record):
+    """Copy of record with numpy scalars converted to Python types."""
+    x = OrderedDict()
+    for key, value in record.items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            value = None
+        x[key] = value
+    return x
+
+
+@contextmanager
+def silenced(quiet=True):
+    """Drops what is printed to stdout inside the block if quiet."""
+    if not quiet:
+        yield
+        return
+    with open(os.devnull, 'w') as f, redirect_stdout(f):
+        yield
+
+
+def _quote(name):
+    return '"'+name.replace('"', '""')+'"'
@@ -1,12 +1,19 @@
 import numpy as np
 import os
 import logging
-import matplotlib.pyplot as plt
+import shutil
+import tempfile
+import hashlib
+import sqlite3
+import json
+import multiprocessing as mp
+from multiprocessing import util
 from . import moog, errors
-from .tools import linfit
+from .tools import linfit, match_lines
 from .star import Star
+from .config import pyplot
+from .results import open_sink, silenced
 import datetime
-from scipy import ma
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
@@ -23,6 +30,10 @@ class SolvePars:
         self.errors = False
         self.check_converged = True
         self.ignore = []
+        self.method = 'steps'
+        self.newton_damping = 1.0
+        self.newton_max_step = 4
+        self.error_workers = 1
 
 class PlotPars:
     def __init__(self):
@@ -49,8 +60,9 @@ def iron_stats(Star, Ref=object, plot=None, PlotPars=object, silent=True):
             return None
     logger.info('Begin iron_stats for '+Star.name)
     logger.info('Calculating abundances for '+Star.name)
-    setattr(Star, 'fe1', moog.abfind(Star, 26.0, 'fe1'))
-    setattr(Star, 'fe2', moog.abfind(Star, 26.1, 'fe2'))
+    fe = moog.abfind_multi(Star, [26.0, 26.1])
+    setattr(Star, 'fe1', fe[26.0])
+    setattr(Star, 'fe2', fe[26.1])
     if not hasattr(Star, 'fe1') and not hasattr(Star, 'fe2'):
         logger.warning('No fe1/fe2 attribute(s) added to '+Star.name)
         return None
@@ -60,17 +72,14 @@ def iron_stats(Star, Ref=object, plot=None, PlotPars=object, silent=True):
             logger.info('Reference star does not have abundances as '+\
                         'attributes')
             logger.info('Calculating abundances for reference star')
-            setattr(Ref, 'fe1', moog.abfind(Ref, 26.0, 'fe1'))
-            setattr(Ref, 'fe2', moog.abfind(Ref, 26.1, 'fe2'))
-        ww1, ww2 = Star.fe1['ww'], Star.fe2['ww']
-        ww1r, ww2r = Ref.fe1['ww'], Ref.fe2['ww']
-        w1, w2 = np.intersect1d(ww1, ww1r), np.intersect1d(ww2, ww2r)
-        k1 = [i for i, w in zip(range(len(ww1)), ww1) if w in w1]
-        k1r = [i for i, w in zip(range(len(ww1r)), ww1r) if w in w1]
-        k2 = [i for i, w in zip(range(len(ww2)), ww2) if w in w2]
-        k2r = [i for i, w in zip(range(len(ww2r)), ww2r) if w in w2]
-        afe1 = Star.fe1['ab'][k1] - Ref.fe1['ab'][k1r]
-        afe2 = Star.fe2['ab'][k2] - Ref.fe2['ab'][k2r]
+            fe = moog.reference_abundances(Ref, [26.0, 26.1])
+            setattr(Ref, 'fe1', fe[26.0])
+            setattr(Ref, 'fe2', fe[26.1])
+        k1, k1r, afe1 = match_lines(Star.fe1['ww'], Ref.fe1['ww'],
+                                    Star.fe1['ab'], Ref.fe1['ab'])
+        k2, k2r, afe2 = match_lines(Star.fe2['ww'], Ref.fe2['ww'],
+                                    Star.fe2['ab'], Ref.fe2['ab'])
+        afe1, afe2 = afe1[k1], afe2[k2]
         rew1 = np.log10(1e-3*Star.fe1['ew'][k1]/Star.fe1['ww'][k1])
         rew2 = np.log10(1e-3*Star.fe2['ew'][k2]/Star.fe2['ww'][k2])
         ep1, ep2 = Star.fe1['ep'][k1], Star.fe2['ep'][k2]
@@ -104,8 +113,10 @@ def iron_stats(Star, Ref=object, plot=None, PlotPars=object, silent=True):
     eafe = np.std(list(afe1)+list(afe2))
     nfe1, nfe2 = len(afe1), len(afe2)
 
-    zero_ep, slope_ep, err_slope_ep = linfit(ep1, afe1)
-    zero_rew, slope_rew, err_slope_rew = linfit(rew1, afe1)
+    #both trends of FeI abundance in one batched fit
+    zero, slope, err_slope = linfit([ep1, rew1], [afe1, afe1])
+    zero_ep, slope_ep, err_slope_ep = zero[0], slope[0], err_slope[0]
+    zero_rew, slope_rew, err_slope_rew = zero[1], slope[1], err_slope[1]
     x_epfit = np.array([min(ep1), max(ep1)])
     y_epfit = zero_ep + slope_ep*x_epfit
     x_rewfit = np.array([min(rew1), max(rew1)])
@@ -113,6 +124,7 @@ def iron_stats(Star, Ref=object, plot=None, PlotPars=object, silent=True):
 
     if plot:
         logger.info('Making figure')
+        plt = pyplot()
         plt.figure(figsize=(7, 9))
         title = Star.name+' : '+str(int(Star.teff))+', '+str(Star.logg)+', ' \
                 +str(round(Star.feh,3))+', '+str(Star.vt)
@@ -232,6 +244,7 @@ def solve_one(Star, SolveParsInit, Ref=object, PlotPars=object):
                          'Fixing problem now.')
             Ref.get_model_atmosphere(sp.grid)
 
+    Star.sp_jacobian = None
     dtv, dgv, dvv, stop_iter = [], [], [], False
     if hasattr(Star, 'converged'):
         if not Star.converged:
@@ -245,91 +258,92 @@ def solve_one(Star, SolveParsInit, Ref=object, PlotPars=object):
     print('it Teff logg [Fe/H]  vt           [Fe/H]')
     print('-- ---- ---- ------ ----      --------------')
 
-    for i in range(sp.niter+1):
-        if sp.step_teff <= 1 and sp.step_logg <= 0.01 \
-           and sp.step_vt <= 0.01:
-            if not stop_iter:
-                Star.converged = False
-                if SolveParsInit.niter > 0:
-                    print('-- Begin final loop')
-            stop_iter = True
-
-        if i > 0:
-            if Star.iron_stats['slope_ep'] > 0:
-                Star.teff += sp.step_teff
+    use_steps = True
+    if sp.method == 'newton' and sp.niter > 0:
+        use_steps = not _solve_newton(Star, sp, Ref, PlotPars)
+        if use_steps:
+            #Newton steps stalled: finish with the final loop of the step
+            #method (zero steps still keep their parameters fixed)
+            print('-- Newton steps stalled. Continuing with steps.')
+            sp.step_teff = min(sp.step_teff, 1)
+            sp.step_logg = min(sp.step_logg, 0.01)
+            sp.step_vt = min(sp.step_vt, 0.01)
+    if use_steps:
+        for i in range(sp.niter+1):
+            if sp.step_teff <= 1 and sp.step_logg <= 0.01 \
+               and sp.step_vt <= 0.01:
+                if not stop_iter:
+                    Star.converged = False
+                    if SolveParsInit.niter > 0:
+                        print('-- Begin final loop')
+                stop_iter = True
+
+            if i > 0:
+                if Star.iron_stats['slope_ep'] > 0:
+                    Star.teff += sp.step_teff
+                else:
+                    Star.teff -= sp.step_teff
+                if Star.teff > 7000:
+                    Star.teff = 7000
+                if Star.iron_stats['slope_rew'] > 0:
+                    Star.vt += sp.step_vt
+                else:
+                    Star.vt -= sp.step_vt
+                if Star.vt < 0:
+                    Star.vt = 0
+                dfe = Star.iron_stats['afe1'] - Star.iron_stats['afe2']
+                if dfe > 0:
+                    Star.logg += sp.step_logg
+                else:
+                    Star.logg -= sp.step_logg
+                if Star.logg > 5.0:
+                    Star.logg = 5.0
+
+                _update_feh(Star, sp, Ref)
+
+                Star.get_model_atmosphere(sp.grid)
+
+            if i+1 == sp.niter or sp.niter == 0:
+                plot = Star.name
+                if hasattr(Ref, 'name'):
+                    plot = Star.name+'-'+Ref.name
+                    if Star.name == Ref.name:
+                        plot = None
+                        Star.converged = ''
             else:
-                Star.teff -= sp.step_teff
-            if Star.teff > 7000:
-                Star.teff = 7000
-            if Star.iron_stats['slope_rew'] > 0:
-                Star.vt += sp.step_vt
-            else:
-                Star.vt -= sp.step_vt
-            if Star.vt < 0:
-                Star.vt = 0
-            dfe = Star.iron_stats['afe1'] - Star.iron_stats['afe2']
-            if dfe > 0:
-                Star.logg += sp.step_logg
-            else:
-                Star.logg -= sp.step_logg
-            if Star.logg > 5.0:
-                Star.logg = 5.0
-
-            if hasattr(Ref, 'name'):
-                Star.feh = Ref.feh + Star.iron_stats['afe']
-            else:
-                Star.feh = Star.iron_stats['afe'] - sp.solar_afe
-            if Star.feh > 1.0:
-                Star.feh = 1.0
-            if Star.feh > 0.5 and sp.grid != 'over':
-                Star.feh = 0.5
-
-            Star.get_model_atmosphere(sp.grid)
-
-        if i+1 == sp.niter or sp.niter == 0:
-            plot = Star.name
-            if hasattr(Ref, 'name'):
-                plot = Star.name+'-'+Ref.name
-                if Star.name == Ref.name:
-                    plot = None
-                    Star.converged = ''
-        else:
-            plot = None
-
-        is_done = iron_stats(Star, Ref=Ref, plot=plot, PlotPars=PlotPars)
-
-        print("{0:2.0f} {1:4.0f} {2:4.2f} {3:6.3f} {4:4.2f}"\
-              " ---> {5:6.3f}+/-{6:5.3f}".\
-                format(i, Star.teff, Star.logg, Star.feh, Star.vt,
-                          Star.iron_stats['afe'], Star.iron_stats['err_afe']))
-
-        dtv.append(Star.teff)
-        dgv.append(Star.logg)
-        dvv.append(Star.vt)
-
-        if i >= 4:
-            if np.std(dtv[-5:]) <= 0.8*sp.step_teff and \
-               np.std(dgv[-5:]) <= 0.8*sp.step_logg and \
-               np.std(dvv[-5:]) <= 0.8*sp.step_vt:
-                print('-- Converged at iteration '+str(i)+ \
-                      ' of '+str(sp.niter))
-                if stop_iter:
-                    plot = Star.name
-                    if hasattr(Ref, 'name'):
-                        plot = Star.name+'-'+Ref.name
-                    iron_stats(Star, Ref=Ref, plot=plot, PlotPars=PlotPars)
-                    Star.converged = True
-                    Star.stop_iter = i
-                    break
-                sp.step_teff = sp.step_teff/2
-                sp.step_logg = sp.step_logg/2
-                sp.step_vt = sp.step_vt/2
-                if sp.step_teff < 1 and sp.step_teff > 0:
-                    sp.step_teff = 1
-                if sp.step_logg < 0.01 and sp.step_logg > 0:
-                    sp.step_logg = 0.01
-                if sp.step_vt < 0.01 and sp.step_vt > 0:
-                    sp.step_vt = 0.01
+                plot = None
+
+            is_done = iron_stats(Star, Ref=Ref, plot=plot, PlotPars=PlotPars)
+
+            _print_iteration(i, Star)
+
+            dtv.append(Star.teff)
+            dgv.append(Star.logg)
+            dvv.append(Star.vt)
+
+            if i >= 4:
+                if np.std(dtv[-5:]) <= 0.8*sp.step_teff and \
+                   np.std(dgv[-5:]) <= 0.8*sp.step_logg and \
+                   np.std(dvv[-5:]) <= 0.8*sp.step_vt:
+                    print('-- Converged at iteration '+str(i)+ \
+                          ' of '+str(sp.niter))
+                    if stop_iter:
+                        plot = Star.name
+                        if hasattr(Ref, 'name'):
+                            plot = Star.name+'-'+Ref.name
+                        iron_stats(Star, Ref=Ref, plot=plot, PlotPars=PlotPars)
+                        Star.converged = True
+                        Star.stop_iter = i
+                        break
+                    sp.step_teff = sp.step_teff/2
+                    sp.step_logg = sp.step_logg/2
+                    sp.step_vt = sp.step_vt/2
+                    if sp.step_teff < 1 and sp.step_teff > 0:
+                        sp.step_teff = 1
+                    if sp.step_logg < 0.01 and sp.step_logg > 0:
+                        sp.step_logg = 0.01
+                    if sp.step_vt < 0.01 and sp.step_vt > 0:
+                        sp.step_vt = 0.01
 
     if not Star.converged:
         if hasattr(Ref, 'name'):
@@ -380,8 +394,208 @@ def solve_one(Star, SolveParsInit, Ref=object, PlotPars=object):
         print('------------------------------------------------------')
 
 
+def _update_feh(Star, sp, Ref=object):
+    if hasattr(Ref, 'name'):
+        Star.feh = Ref.feh + Star.iron_stats['afe']
+    else:
+        Star.feh = Star.iron_stats['afe'] - sp.solar_afe
+    if Star.feh > 1.0:
+        Star.feh = 1.0
+    if Star.feh > 0.5 and sp.grid != 'over':
+        Star.feh = 0.5
+
+
+def _print_iteration(i, Star):
+    print("{0:2.0f} {1:4.0f} {2:4.2f} {3:6.3f} {4:4.2f}"\
+          " ---> {5:6.3f}+/-{6:5.3f}".\
+            format(i, Star.teff, Star.logg, Star.feh, Star.vt,
+                      Star.iron_stats['afe'], Star.iron_stats['err_afe']))
+
+
+#finite-difference steps in teff, vt, and logg (same as errors.error_one)
+JACOBIAN_STEPS = (20, 0.02, 0.02)
+
+
+def _sp_vector(Star):
+    return np.array([Star.teff, Star.vt, Star.logg], dtype=float)
+
+
+def _set_sp_vector(Star, p, grid):
+    """Sets teff, vt, and logg (rounded to 1 K, 0.01, and 0.01, within
+    the limits used by solve_one) and gets the new model atmosphere.
+    """
+    Star.teff = int(round(min(p[0], 7000)))
+    Star.vt = round(max(p[1], 0), 2)
+    Star.logg = round(min(p[2], 5.0), 2)
+    Star.get_model_atmosphere(grid)
+
+
+def iron_residuals(Star):
+    """Returns slope_ep, slope_rew, FeI-FeII and their errors."""
+    x = Star.iron_stats
+    r = np.array([x['slope_ep'], x['slope_rew'], x['afe1']-x['afe2']])
+    e = np.array([x['err_slope_ep'], x['err_slope_rew'],
+                  np.sqrt(x['err_afe1']**2+x['err_afe2']**2)/\
+                  np.sqrt(x['nfe1']+x['nfe2'])])
+    return r, e
+
+
+def iron_jacobian(Star_in, SolvePars, Ref=object, steps=JACOBIAN_STEPS):
+    """Central-difference derivatives of slope_ep, slope_rew, and FeI-FeII
+    (rows) with respect to teff, vt, and logg (columns) at the current
+    parameters of Star_in, which is not modified.
+    """
+    s = Star()
+    s.__dict__ = Star_in.__dict__.copy()
+    p = _sp_vector(s)
+    jacobian = np.zeros((3, 3))
+    for k in range(3):
+        r, x = [], []
+        for sign in [1, -1]:
+            q = p.copy()
+            q[k] += sign*steps[k]
+            _set_sp_vector(s, q, SolvePars.grid)
+            iron_stats(s, Ref=Ref)
+            r.append(iron_residuals(s)[0])
+            x.append(_sp_vector(s)[k])
+        jacobian[:, k] = (r[0]-r[1])/(x[0]-x[1])
+    return jacobian
+
+
+def _solve_newton(Star, sp, Ref=object, PlotPars=object):
+    """Iterations of solve_one for SolvePars.method = 'newton'
+
+    Damped Newton steps on (teff, vt, logg) towards zero slope_ep,
+    slope_rew, and FeI-FeII. The Jacobian is computed with central
+    differences at the start and kept up to date with Broyden updates;
+    it is computed again when a step fails to reduce the residuals
+    (weighted by their errors), and before convergence is accepted. If
+    no step reduces them even with a freshly computed Jacobian, the star
+    is left at its best point and False is returned, so that solve_one
+    can finish with the step method; otherwise True is returned.
+    Convergence is reached when the Newton step is no larger than the
+    final resolution of the step method (1 K, 0.01 km/s, 0.01 dex).
+    Parameters with a step of zero are kept fixed and, as in the step
+    method, their residual (slope_ep for teff, slope_rew for vt, FeI-FeII
+    for logg) is left out.
+    """
+    Star.converged = False
+    resolution = np.array([1, 0.01, 0.01])
+    scale = np.array([sp.step_teff, sp.step_vt, sp.step_logg], dtype=float)
+    free = scale > 0
+    weight = np.where(free, 1./np.where(free, scale, 1.)**2, 0.)
+    iron_stats(Star, Ref=Ref)
+    _print_iteration(0, Star)
+    r, e = iron_residuals(Star)
+    e[e <= 0] = 1
+    jacobian, fresh = iron_jacobian(Star, sp, Ref), True
+    for i in range(1, sp.niter+1):
+        dp = np.zeros(3)
+        if free.any():
+            dp[free] = np.linalg.lstsq(jacobian[free][:, free]/
+                                       e[free, None], -r[free]/e[free],
+                                       rcond=None)[0]
+            largest = np.max(np.abs(dp[free])/
+                             (sp.newton_max_step*scale[free]))
+            if largest > 1:
+                dp = dp/largest
+        if np.all(np.abs(dp) <= resolution):
+            if fresh:
+                Star.converged = True
+                Star.stop_iter = i-1
+                print('-- Converged at iteration '+str(i-1)+ \
+                      ' of '+str(sp.niter))
+                break
+            jacobian, fresh = iron_jacobian(Star, sp, Ref), True
+            continue
+
+        p = _sp_vector(Star)
+        _update_feh(Star, sp, Ref)
+        damping, improved = sp.newton_damping, False
+        for k in range(4):
+            _set_sp_vector(Star, p+damping*dp, sp.grid)
+            iron_stats(Star, Ref=Ref)
+            r_new, e_new = iron_residuals(Star)
+            if np.sum((r_new/e)[free]**2) < np.sum((r/e)[free]**2):
+                improved = True
+                break
+            damping = damping/2
+        if not improved:
+            #back to the best point so far
+            _set_sp_vector(Star, p, sp.grid)
+            iron_stats(Star, Ref=Ref)
+            r_new, e_new = iron_residuals(Star)
+            if fresh:
+                #a new Jacobian here would give the same steps again
+                _print_iteration(i, Star)
+                return False
+        _print_iteration(i, Star)
+
+        step = _sp_vector(Star) - p
+        if improved:
+            if np.sum(step**2*weight) > 0:
+                jacobian = jacobian + np.outer(r_new-r-jacobian.dot(step),
+                                               step*weight)/\
+                                      np.sum(step**2*weight)
+                fresh = False
+        else:
+            jacobian, fresh = iron_jacobian(Star, sp, Ref), True
+        r, e = r_new, e_new
+        e[e <= 0] = 1
+
+    if Star.converged:
+        Star.sp_jacobian = jacobian
+        Star.sp_jacobian_at = (Star.teff, Star.vt, Star.logg, Star.feh)
+    plot = Star.name
+    if hasattr(Ref, 'name'):
+        plot = Star.name+'-'+Ref.name
+    iron_stats(Star, Ref=Ref, plot=plot, PlotPars=PlotPars)
+    return True
+
+
+#columns of the solve_all output and their CSV formats
+SOLUTION_COLUMNS = ['id', 'teff', 'logg', 'feh_model', 'vt', 'feh',
+                    'err_feh_', 'feh1', 'err_feh1', 'nfe1', 'feh2',
+                    'err_feh2', 'nfe2', 'slope_ep', 'err_slope_ep',
+                    'slope_rew', 'err_slope_rew', 'stop_iter', 'converged',
+                    'err_teff', 'err_logg', 'err_feh', 'err_vt']
+_round3 = lambda x: str(round(x, 3))
+SOLUTION_FORMATS = ['{}', '{:4.0f}', '{:5.3f}', _round3, '{:4.2f}', _round3,
+                    '{:5.3f}', _round3, '{:5.3f}', '{}', _round3,
+                    '{:5.3f}', '{}', '{:.6f}', '{:.6f}',
+                    '{:.6f}', '{:.6f}', '{}', '{}',
+                    '{:3.0f}', '{:5.3f}', '{:5.3f}', '{:4.2f}']
+
+
+def solution_columns(errors):
+    """Output columns of solve_all. Without errors, the iron abundance
+    error is 'err_feh' and the (empty) parameter error is 'err_feh_'.
+    """
+    columns = list(SOLUTION_COLUMNS)
+    if not errors:
+        columns[6], columns[21] = 'err_feh', 'err_feh_'
+    return columns
+
+
 def solve_all(Data, SolveParsInit, output_file, reference_star=None,
-              PlotPars=object):
+              PlotPars=object, workers=1, checkpoint=True, quiet=False):
+    """Runs solve_one for every star in Data and writes the solutions to
+    output_file. With workers > 1 the stars are spread across a pool of
+    processes, each using its own MOOG scratch directory. Rows are always
+    written in the order of Data.star_data['id'].
+
+    output_file can be a CSV file, a JSON-lines file (.jsonl), an sqlite
+    database (.sqlite or .db), or a sink object (see q2.results). Each
+    star is written out as soon as it is done. If quiet is True, the
+    per-star iteration tables are not printed.
+
+    Each finished star is recorded in a checkpoint file (output_file
+    plus '.ckpt', or the path given as checkpoint; checkpoint=False turns
+    this off). Sink objects without a file_name attribute need an explicit
+    checkpoint path. If solve_all is interrupted, running it again with the
+    same data and settings skips the stars already done. The checkpoint
+    file is deleted when solve_all finishes.
+    """
     print('------------------------------------------------------')
     print('Initializing ...')
     start_time = datetime.datetime.now()
@@ -389,90 +603,86 @@ def solve_all(Data, SolveParsInit, output_file, reference_star=None,
     print('- Model atmospheres: '+SolveParsInit.grid)
     print('- Star data: '+Data.star_data_fname)
     print('- Line list: '+Data.lines_fname)
+    if workers > 1:
+        print('- Worker processes: '+str(workers))
+    star_ids = list(Data.star_data['id'])
+    sink = open_sink(output_file)
+    journal = None
+    if checkpoint is True:
+        if getattr(sink, 'file_name', None):
+            checkpoint = sink.file_name+'.ckpt'
+        else:
+            logger.warning('Output sink has no file name; no checkpoint '+\
+                           'is kept (pass a checkpoint path to keep one).')
+            checkpoint = False
+    if checkpoint:
+        journal = _Checkpoint(checkpoint,
+                              _fingerprint(Data, SolveParsInit,
+                                           reference_star, star_ids))
+        if journal.done:
+            print('- Resuming from: '+checkpoint+' ('+\
+                  str(len(journal.done))+' stars done)')
     print('------------------------------------------------------')
     if reference_star:
         Ref = Star(reference_star)
         Ref.get_data_from(Data)
+        #done once here; solve_one (and every worker) only reads them
+        Ref.get_model_atmosphere(SolveParsInit.grid)
+        fe = moog.reference_abundances(Ref, [26.0, 26.1])
+        Ref.fe1, Ref.fe2 = fe[26.0], fe[26.1]
     else:
         Ref = None
-    fout = open(output_file, 'w')
-    if SolveParsInit.errors:
-        fout.write('id,teff,logg,feh_model,vt,feh,err_feh_,'+
-                   'feh1,err_feh1,nfe1,feh2,err_feh2,nfe2,'
-                   'slope_ep,err_slope_ep,slope_rew,err_slope_rew,'
-                   'stop_iter,converged,'
-                   'err_teff,err_logg,err_feh,err_vt\n')
+    columns = solution_columns(SolveParsInit.errors)
+    sink.start(columns, dict(zip(columns, SOLUTION_FORMATS)))
+    done = journal.done if journal else {}
+    if workers > 1:
+        #results arrive as stars finish; hold them until all earlier
+        #stars are written so that the output keeps the input order
+        pending, next_idx = {}, 0
+        todo = []
+        for idx, star_id in enumerate(star_ids):
+            if star_id in done:
+                pending[idx] = done[star_id]
+            else:
+                todo.append((idx, star_id))
+        if todo:
+            pool = mp.Pool(workers, initializer=_init_worker,
+                           initargs=(Data, SolveParsInit, Ref, PlotPars,
+                                     quiet))
+            results = pool.imap_unordered(_solve_star_worker, todo)
+        else:
+            pool, results = None, []
+        for idx, record in results:
+            if journal and record is not False:
+                journal.add(str(star_ids[idx]), record)
+            pending[idx] = record
+            while next_idx in pending:
+                record = pending.pop(next_idx)
+                if record:
+                    sink.write(record)
+                next_idx += 1
+        while next_idx in pending:
+            record = pending.pop(next_idx)
+            if record:
+                sink.write(record)
+            next_idx += 1
+        if pool:
+            pool.close()
+            pool.join()
     else:
-        fout.write('id,teff,logg,feh_model,vt,feh,err_feh,'+
-                   'feh1,err_feh1,nfe1,feh2,err_feh2,nfe2,'
-                   'slope_ep,err_slope_ep,slope_rew,err_slope_rew,'
-                   'stop_iter,converged,'
-                   'err_teff,err_logg,err_feh_,err_vt\n')
-    for star_id in Data.star_data['id']:
-        print('')
-        print('*'*len(star_id))
-        print(star_id)
-        print('*'*len(star_id))
-        s = Star(star_id)
-        try:
-            s.get_data_from(Data)
-        except:
-            logger.warning('No data found for '+s.name+\
-                        '. Excluded from output file.')
-            print('Data not found.')
-            #fout.write("{0},,,,,,,,,,"\
-            #           ",,,,,,,,,,,,\n".\
-            #           format(s.name))
-            continue
-        if ma.count(Data.lines[star_id]) == 0:
-            print('Line data not found.')
-            continue
-        sp = SolvePars()
-        sp.__dict__ = SolveParsInit.__dict__.copy()
-        if reference_star:
-            if s.name == Ref.name:
-                sp.niter = 0
-                print('Reference star. No calculations needed.')
-                #continue
-        if hasattr(s, 'converged') and sp.check_converged:
-            if s.converged == 'True':
-                print('Already converged.')
-                continue
-                #sp.niter = 0
-                #s.converged = True
-        if s.name in sp.ignore:
-            print('Asked to ignore.')
-            continue
-
-        solve_one(s, sp, Ref, PlotPars=PlotPars)
-
-        if sp.niter == 0:
-            s.converged = ''
-
-        fout.write("{0},{1:4.0f},{2:5.3f},{3},{4:4.2f},{5},{6:5.3f},"\
-                   "{7},{8:5.3f},{9},"\
-                   "{10},{11:5.3f},{12},{13:.6f},{14:.6f},"\
-                   "{15:.6f},{16:.6f},{17},{18},"\
-                   "{19:3.0f},{20:5.3f},{21:5.3f},{22:4.2f}\n".\
-                   format(s.name, s.teff, s.logg, str(round(s.feh,3)), s.vt,
-                          str(round(s.iron_stats['afe'],3)),
-                          s.iron_stats['err_afe'],
-                          str(round(s.iron_stats['afe1'],3)),
-                          s.iron_stats['err_afe1'],
-                          s.iron_stats['nfe1'],
-                          str(round(s.iron_stats['afe2'],3)),
-                          s.iron_stats['err_afe2'],
-                          s.iron_stats['nfe2'],
-                          s.iron_stats['slope_ep'],
-                          s.iron_stats['err_slope_ep'],
-                          s.iron_stats['slope_rew'],
-                          s.iron_stats['err_slope_rew'],
-                          s.stop_iter,
-                          s.converged,
-                          s.sp_err['teff'], s.sp_err['logg'],
-                          s.sp_err['afe'], s.sp_err['vt']
-                          ))
-    fout.close()
+        for star_id in star_ids:
+            if star_id in done:
+                record = done[star_id]
+            else:
+                record = _solve_star(star_id, Data, SolveParsInit, Ref,
+                                     PlotPars, quiet)
+                if journal and record is not False:
+                    journal.add(str(star_id), record)
+            if record:
+                sink.write(record)
+    sink.close()
+    if journal:
+        journal.remove()
 
     print('')
     print('------------------------------------------------------')
@@ -487,36 +697,196 @@ def solve_all(Data, SolveParsInit, output_file, reference_star=None,
     print('')
 
 
+class _Checkpoint:
+    """sqlite journal of the output records (as JSON) of the stars already
+    done by solve_all, tagged with a fingerprint of the run settings.
+    """
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '+\
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stars '+\
+                        '(id TEXT PRIMARY KEY, record TEXT)')
+        x = self.db.execute("SELECT value FROM meta "+\
+                            "WHERE key='fingerprint'").fetchone()
+        if x and x[0] != fingerprint:
+            logger.warning('Checkpoint '+path+' is from a run with '+\
+                           'different data or settings. Starting over.')
+            self.db.execute('DELETE FROM stars')
+        self.db.execute("INSERT OR REPLACE INTO meta "+\
+                        "VALUES ('fingerprint', ?)", (fingerprint,))
+        self.db.commit()
+        self.done = {}
+        for star_id, record in self.db.execute('SELECT id, record '+\
+                                               'FROM stars'):
+            self.done[star_id] = json.loads(record,
+                                            object_pairs_hook=OrderedDict)
+
+    def add(self, star_id, record):
+        record = json.dumps(record, default=lambda x: x.item())
+        self.db.execute('INSERT OR REPLACE INTO stars VALUES (?, ?)',
+                        (star_id, record))
+        self.db.commit()
+
+    def remove(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+def _fingerprint(Data, SolveParsInit, reference_star, star_ids):
+    h = hashlib.sha1()
+    for x in [sorted(SolveParsInit.__dict__.items()), reference_star,
+              Data.star_data_fname, Data.lines_fname,
+              [str(star_id) for star_id in star_ids]]:
+        h.update(repr(x).encode())
+    return h.hexdigest()
+
+
+def _solve_star(star_id, Data, SolveParsInit, Ref=None, PlotPars=object,
+                quiet=False):
+    """Solves one star of a solve_all run and returns its output record.
+    Returns None if the star is skipped and False if the calculation fails
+    (these stars are not kept in the checkpoint, so they are tried again).
+    """
+    with silenced(quiet):
+        s = _solve_star_quietly(star_id, Data, SolveParsInit, Ref, PlotPars)
+    if not s:
+        return s
+    return solution_record(s, SolveParsInit.errors)
+
+
+def solution_record(s, errors=False):
+    """Output record (column -> value) of solve_all for Star s."""
+    x = s.iron_stats
+    values = [s.name, s.teff, s.logg, s.feh, s.vt,
+              x['afe'], x['err_afe'], x['afe1'], x['err_afe1'], x['nfe1'],
+              x['afe2'], x['err_afe2'], x['nfe2'],
+              x['slope_ep'], x['err_slope_ep'],
+              x['slope_rew'], x['err_slope_rew'],
+              s.stop_iter, s.converged,
+              s.sp_err['teff'], s.sp_err['logg'],
+              s.sp_err['afe'], s.sp_err['vt']]
+    return OrderedDict(zip(solution_columns(errors), values))
+
+
+def _solve_star_quietly(star_id, Data, SolveParsInit, Ref, PlotPars):
+    print('')
+    print('*'*len(star_id))
+    print(star_id)
+    print('*'*len(star_id))
+    s = Star(star_id)
+    try:
+        s.get_data_from(Data)
+    except:
+        logger.warning('No data found for '+s.name+\
+                    '. Excluded from output file.')
+        print('Data not found.')
+        return None
+    if not Data.has_ew(star_id).any():
+        print('Line data not found.')
+        return None
+    sp = SolvePars()
+    sp.__dict__ = SolveParsInit.__dict__.copy()
+    if Ref:
+        if s.name == Ref.name:
+            sp.niter = 0
+            print('Reference star. No calculations needed.')
+    if hasattr(s, 'converged') and sp.check_converged:
+        if s.converged == 'True':
+            print('Already converged.')
+            return None
+    if s.name in sp.ignore:
+        print('Asked to ignore.')
+        return None
+
+    try:
+        solve_one(s, sp, Ref, PlotPars=PlotPars)
+    except Exception:
+        logger.exception('Unable to solve '+s.name+\
+                         '. Excluded from output file.')
+        print('Calculation failed.')
+        return False
+    if not hasattr(s, 'iron_stats') or not hasattr(s, 'sp_err'):
+        #e.g., no starting model atmosphere (solve_one returns None)
+        logger.warning('Unable to solve '+s.name+\
+                       '. Excluded from output file.')
+        print('Calculation failed.')
+        return False
+
+    if sp.niter == 0:
+        s.converged = ''
+    return s
+
+
+_worker_args = None
+
+def _init_worker(Data, SolveParsInit, Ref, PlotPars, quiet=False):
+    """Pool initializer: keeps the solve_all arguments in the worker and
+    gives it a MOOG scratch directory of its own.
+    """
+    global _worker_args
+    _worker_args = (Data, SolveParsInit, Ref, PlotPars, quiet)
+    os.makedirs(moog.scratch_dir, exist_ok=True)
+    moog.scratch_dir = tempfile.mkdtemp(prefix='worker',
+                                        dir=moog.scratch_dir)
+    util.Finalize(None, shutil.rmtree, args=(moog.scratch_dir, True),
+                  exitpriority=10)
+
+def _solve_star_worker(args):
+    idx, star_id = args
+    return idx, _solve_star(star_id, *_worker_args)
+
+
 def make_single_solution_table(solution_files, single_solution_file):
     """Takes q2.specpars.solve_all outputs and creates a single final one
 
     Files must be in the order in which they were computed!
+    (see merge_solutions)
     """
-    #solution_files = ['starsDec_solution1.csv', 'starsDec_solution2.csv']
-    #single_solution_file = 'starsDec_solution.csv'
-    fout = open(single_solution_file, 'w')
-    with open(solution_files[0], 'r') as f:
-        lines = f.readlines()
-    for line in lines:
-        sid = line[0:line.index(',')]
-        if 'True' in line or 'id,teff' in line:
-            #nline = line[0:line.rfind('\n')]
-            #linew = nline[0:nline.rfind('\n')]
-            #fout.write(linew+'\n')
-            #print line
-            fout.write(line)
-        else:
-            for i in range(1, len(solution_files)):
-                with open(solution_files[i], 'r') as f2:
-                    lines2 = f2.readlines()
-                for line2 in lines2:
-                    sid2 = line2[0:line2.index(',')]
-                    #nline2 = line2[0:line2.rfind(',')]
-                    #line2w = nline2[0:nline2.rfind(',')]
-                    if 'True' in line2 and sid == sid2:
-                        #fout.write(line2w+'\n')
-                        fout.write(line2)
-    fout.close()
+    merge_solutions(solution_files, single_solution_file)
+
+
+def merge_solutions(solution_files, output_file):
+    """Merges q2.specpars.solve_all CSV outputs into a single one
+
+    Files must be in the order in which they were computed: for each star
+    the row of the last file in which it converged is kept (converged
+    column equal to 'True'). Stars that did not converge in any file are
+    left out. Rows follow the order of the first file; stars found only
+    in later files go at the end. Each file is read once.
+    """
+    order, best = [], {}
+    header = None
+    for solution_file in solution_files:
+        with open(solution_file, 'r') as f:
+            lines = f.read().splitlines()
+        if not lines:
+            continue
+        keys = lines[0].split(',')
+        if header is None:
+            header = lines[0]
+        if 'converged' not in keys:
+            logger.warning(solution_file+' has no converged column. '+\
+                           'Skipped.')
+            continue
+        k = keys.index('converged')
+        for line in lines[1:]:
+            cells = line.split(',')
+            if len(cells) <= k:
+                continue
+            sid = cells[0]
+            if sid not in best:
+                best[sid] = None
+                order.append(sid)
+            if cells[k] == 'True':
+                best[sid] = line
+    with open(output_file, 'w') as fout:
+        if header is not None:
+            fout.write(header+'\n')
+        for sid in order:
+            if best[sid] is not None:
+                fout.write(best[sid]+'\n')
 
 
 def fancy_ironstats_plot(Star):
@@ -1,19 +1,35 @@
 import numpy as np
 import logging
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 from . import modatm
 from .config import *
-from .tools import read_csv
+from .tools import read_csv, is_missing, check_keys, index_csv, \
+                   read_csv_column
 
 logger = logging.getLogger(__name__)
 
 
+LINE_COLUMNS = ['wavelength', 'species', 'ep', 'gf']
+SNAPSHOT_VERSION = 1
+
+
 class Data:
     """q2 Data objects contain the information from the input star
     and lines CSV files as attributes 'star_data' and 'lines'.
     """
-    def __init__(self, fname_star_data, fname_lines=None):
+    def __init__(self, fname_star_data, fname_lines=None, ew_dtype=np.float64,
+                 lazy=False):
         """Takes as input a star data file (CSV, required) and a line-list
-        data file (CSV, optional) to create a q2 data object.
+        data file (CSV, optional) to create a q2 data object. EW columns
+        are stored as ew_dtype arrays (np.float64 or np.float32) with NaN
+        for lines not measured. If lazy is True, the EW column of a star
+        is read from the lines file only when it is first accessed (see
+        LazyLines).
         """
         try:
             self.star_data = read_csv(fname_star_data, file_type='stars')
@@ -25,14 +41,20 @@ class Data:
             self.star_data = None
             self.star_data_fname = None
             logger.error('Star data file not found.')
+        self.index_stars()
 
         if fname_lines:
             try:
-                self.lines = read_csv(fname_lines, file_type='lines')
+                if lazy:
+                    self.lines = LazyLines(fname_lines, ew_dtype)
+                else:
+                    self.lines = read_csv(fname_lines, file_type='lines')
                 self.lines_fname = fname_lines
                 if not self.lines:
                     logger.error('Lines data file not read. Data.lines '+\
                                  'attribute set to None.')
+                elif not lazy:
+                    self._type_ew_columns(ew_dtype)
             except:
                 self.lines = None
                 self.lines_fname = None
@@ -47,6 +69,127 @@ class Data:
         if self.lines:
             logger.info('lines_data attribute added to Data object.')
 
+    def index_stars(self):
+        """Builds star_index, a dict that maps each star id to its row in
+        star_data. Call it again if star_data is modified.
+        """
+        if self.star_data:
+            self.star_index = dict((star_id, idx) for idx, star_id in
+                                   enumerate(self.star_data['id']))
+        else:
+            self.star_index = {}
+
+    def _type_ew_columns(self, ew_dtype):
+        for key in self.lines.keys():
+            if key in LINE_COLUMNS:
+                continue
+            try:
+                self.lines[key] = np.asarray(self.lines[key], dtype=ew_dtype)
+            except (TypeError, ValueError):
+                logger.warning("Column '"+key+"' of lines file is not "+\
+                               "numeric. Left as is.")
+
+    def has_ew(self, star_id):
+        """Validity mask of the EW column of a star: True for lines
+        with a measured EW.
+        """
+        return np.isfinite(self.lines[star_id])
+
+    def save(self, path):
+        """Writes a binary snapshot of the Data object to the directory
+        path: the EW columns as a single (stars, lines) matrix in ew.npy,
+        the remaining columns in stars.npz and lines.npz, and the source
+        file names with their sha1 hashes in meta.json.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        ew_columns = []
+        lines = {}
+        if self.lines:
+            for key in self.lines.keys():
+                column = np.asarray(self.lines[key])
+                if key not in LINE_COLUMNS and column.dtype.kind == 'f':
+                    ew_columns.append(key)
+                else:
+                    lines[key] = column
+            if ew_columns:
+                ew = np.array([self.lines[key] for key in ew_columns])
+                np.save(os.path.join(path, 'ew.npy'), ew)
+        np.savez(os.path.join(path, 'stars.npz'), **(self.star_data or {}))
+        np.savez(os.path.join(path, 'lines.npz'), **lines)
+        meta = {'version': SNAPSHOT_VERSION,
+                'star_data_fname': self.star_data_fname,
+                'star_data_sha1': _file_sha1(self.star_data_fname),
+                'lines_fname': self.lines_fname,
+                'lines_sha1': _file_sha1(self.lines_fname),
+                'has_lines': self.lines is not None,
+                'ew_columns': ew_columns}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        logger.info('Data snapshot saved to '+path)
+
+    @classmethod
+    def load(cls, path, check_sources=False):
+        """Creates a Data object from a snapshot written by Data.save.
+        The EW matrix is memory-mapped, so opening is fast and processes
+        reading the same snapshot share its pages. If check_sources is
+        True, a warning is issued if the source CSV files have changed
+        since the snapshot was made.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError('Unknown Data snapshot version in '+path)
+        self = cls.__new__(cls)
+        self.star_data_fname = meta['star_data_fname']
+        self.lines_fname = meta['lines_fname']
+        self.snapshot_sha1 = {'star_data': meta['star_data_sha1'],
+                              'lines': meta['lines_sha1']}
+        with np.load(os.path.join(path, 'stars.npz'),
+                     allow_pickle=True) as x:
+            self.star_data = dict((key, x[key]) for key in x.files) or None
+        if meta['has_lines']:
+            with np.load(os.path.join(path, 'lines.npz'),
+                         allow_pickle=True) as x:
+                self.lines = dict((key, x[key]) for key in x.files)
+        else:
+            self.lines = None
+        self._snapshot = (path, meta['ew_columns'])
+        self._map_ew_columns()
+        self.index_stars()
+        if check_sources:
+            for fname, sha1 in [(self.star_data_fname, meta['star_data_sha1']),
+                                (self.lines_fname, meta['lines_sha1'])]:
+                if fname and sha1 and os.path.exists(fname) and \
+                   _file_sha1(fname) != sha1:
+                    logger.warning(fname+' has changed since the snapshot '+\
+                                   'in '+path+' was made.')
+        logger.info('Data object loaded from snapshot '+path)
+        return self
+
+    def _map_ew_columns(self):
+        path, ew_columns = self._snapshot
+        if ew_columns:
+            ew = np.load(os.path.join(path, 'ew.npy'), mmap_mode='r')
+            for key, row in zip(ew_columns, ew):
+                self.lines[key] = row
+
+    def __getstate__(self):
+        #memory-mapped EW columns are not pickled; they are mapped again
+        #from the snapshot when unpickled (e.g., in worker processes)
+        state = self.__dict__.copy()
+        if state.get('_snapshot') and state.get('lines'):
+            ew_columns = state['_snapshot'][1]
+            state['lines'] = dict((key, x) for key, x in
+                                  state['lines'].items()
+                                  if key not in ew_columns)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('_snapshot') and state.get('lines') is not None:
+            self._map_ew_columns()
+
     def __repr__(self):
         if self.star_data:
             nstars = len(self.star_data['id'])
@@ -62,6 +205,221 @@ class Data:
                format(self.star_data_fname, nstars, self.lines_fname, nlines)
 
 
+class LazyLines(Mapping):
+    """Read-only dict of the columns of a lines CSV file, used as
+    Data.lines by Data(..., lazy=True). The wavelength, species, ep, and
+    gf columns are read right away; every other column (i.e., the EWs of
+    one star) is read from the file the first time it is accessed, using
+    the row offsets found by tools.index_csv. Memory thus grows with the
+    number of stars used, not with the width of the file. Columns can be
+    dropped again with release().
+    """
+    def __init__(self, fname, ew_dtype=np.float64):
+        self.fname = fname
+        self.ew_dtype = ew_dtype
+        self._index = index_csv(fname)
+        self._columns = {}
+        self._lock = threading.Lock()
+        if not check_keys(self._index[0], fname, 'lines'):
+            raise ValueError('Bad header in lines file '+fname)
+        for key in LINE_COLUMNS:
+            self[key]
+
+    def __getitem__(self, key):
+        x = self._columns.get(key)
+        if x is not None:
+            return x
+        if key not in self._index[0]:
+            raise KeyError(key)
+        x = read_csv_column(self.fname, self._index, key, file_type='lines')
+        if key not in LINE_COLUMNS:
+            try:
+                x = np.asarray(x, dtype=self.ew_dtype)
+            except (TypeError, ValueError):
+                logger.warning("Column '"+key+"' of lines file is not "+\
+                               "numeric. Left as is.")
+        with self._lock:
+            self._columns[key] = x
+        return x
+
+    def __iter__(self):
+        return iter(self._index[0])
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def __contains__(self, key):
+        return key in self._index[0]
+
+    def release(self, keys=None):
+        """Forgets the EW columns already read (all of them if keys is
+        None), so that memory can be reused.
+        """
+        with self._lock:
+            for key in list(self._columns.keys()):
+                if key not in LINE_COLUMNS and (keys is None or key in keys):
+                    del self._columns[key]
+
+    def __getstate__(self):
+        #EW columns are not pickled; workers read the ones they need
+        state = self.__dict__.copy()
+        state['_columns'] = dict((key, self._columns[key])
+                                 for key in LINE_COLUMNS)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def _file_sha1(fname):
+    if not fname or not os.path.isfile(fname):
+        return None
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ModelCache:
+    """Interpolated model atmospheres used by Star.get_model_atmosphere
+
+    Models are keyed on grid and on teff, logg, and [Fe/H] rounded to
+    teff_tol, logg_tol, and feh_tol. On a miss the model is interpolated
+    at the rounded values, so a given key always maps to the same model.
+    The defaults match the precision of the parameters in the input and
+    output files. Up to maxsize models are kept; the least recently used
+    ones are dropped first. hits and misses count cache lookups.
+    """
+    def __init__(self, maxsize=512, teff_tol=1.0, logg_tol=0.001,
+                 feh_tol=0.001):
+        self.enabled = True
+        self.maxsize = maxsize
+        self.teff_tol = teff_tol
+        self.logg_tol = logg_tol
+        self.feh_tol = feh_tol
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Model cache: {0} models (maxsize = {1}), "\
+               "{2} hits, {3} misses".\
+               format(len(self._models), self.maxsize, self.hits,
+                      self.misses)
+
+    def get(self, teff, logg, feh, grid):
+        """Returns the model atmosphere for (teff, logg, feh) in grid."""
+        if not self.enabled:
+            return modatm.interpolate(teff, logg, feh, grid)
+        key = self._key(teff, logg, feh, grid)
+        with self._lock:
+            x = self._models.get(key)
+            if x is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return dict(x)
+            self.misses += 1
+        x = modatm.interpolate(*self._point(key))
+        if x is None:
+            return None
+        self._remember(key, x)
+        return dict(x)
+
+    def get_many(self, teffs, loggs, fehs, grid):
+        """Same as get for many points; the models not in the cache are
+        interpolated together (see modatm.interpolate_many). Returns a
+        list of models (None where interpolation fails).
+        """
+        if not self.enabled:
+            x = modatm.interpolate_many(teffs, loggs, fehs, grid)
+            return [modatm.model_dict(xi) for xi in x]
+        keys = [self._key(teff, logg, feh, grid)
+                for teff, logg, feh in zip(teffs, loggs, fehs)]
+        models, todo = [None]*len(keys), OrderedDict()
+        with self._lock:
+            for i, key in enumerate(keys):
+                x = self._models.get(key)
+                if x is not None:
+                    self._models.move_to_end(key)
+                    self.hits += 1
+                    models[i] = dict(x)
+                else:
+                    self.misses += 1
+                    todo.setdefault(key, []).append(i)
+        if todo:
+            points = [self._point(key) for key in todo]
+            x = modatm.interpolate_many([p[0] for p in points],
+                                        [p[1] for p in points],
+                                        [p[2] for p in points], grid)
+            for key, xi in zip(todo, x):
+                xi = modatm.model_dict(xi)
+                if xi is None:
+                    continue
+                self._remember(key, xi)
+                for i in todo[key]:
+                    models[i] = dict(xi)
+        return models
+
+    def _key(self, teff, logg, feh, grid):
+        return (grid, int(round(teff/self.teff_tol)),
+                int(round(logg/self.logg_tol)), int(round(feh/self.feh_tol)))
+
+    def _point(self, key):
+        return (round(key[1]*self.teff_tol, 6),
+                round(key[2]*self.logg_tol, 6),
+                round(key[3]*self.feh_tol, 6), key[0])
+
+    def _remember(self, key, x):
+        with self._lock:
+            self._models[key] = x
+            while len(self._models) > self.maxsize:
+                self._models.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self.hits = 0
+            self.misses = 0
+
+model_cache = ModelCache()
+
+
+def get_model_atmospheres(Data, grid='odfnew', star_ids=None):
+    """Gets the model atmospheres of the stars star_ids (all stars in Data
+    by default) in a single pass through model_cache (see
+    ModelCache.get_many). feh_model is used instead of feh where
+    available. Returns a dict with star ids as keys (only stars with teff,
+    logg, and [Fe/H] known are included).
+    """
+    if star_ids is None:
+        star_ids = Data.star_data['id']
+    ids, teffs, loggs, fehs = [], [], [], []
+    for star_id in star_ids:
+        idx = Data.star_index.get(star_id)
+        if idx is None:
+            continue
+        pars = []
+        for par in ['teff', 'logg', 'feh_model', 'feh']:
+            if par in Data.star_data.keys():
+                pars.append(Data.star_data[par][idx])
+            else:
+                pars.append(None)
+        if is_missing(pars[2]):
+            pars[2] = pars[3]
+        if any(is_missing(par) for par in pars[:3]):
+            continue
+        ids.append(star_id)
+        teffs.append(pars[0])
+        loggs.append(pars[1])
+        fehs.append(pars[2])
+    models = model_cache.get_many(teffs, loggs, fehs, grid)
+    return dict(zip(ids, models))
+
+
 class Star:
     """q2 Star objects contain information about a star (e.g., Teff, logg,
     etc). This information can be grabbed from a q2.Data object using the
@@ -112,13 +470,11 @@ class Star:
         """If the Star object has a name that matches one of the id's in
         a Data object, the information from Data will be given to Star.
         """
-        #idx must correspond to a unique id; hence the [0][0]
-        try:
-            idx = np.where(Data.star_data['id'] == self.name)[0][0]
-            logger.info("Star '"+self.name+"' found in data object.")
-        except:
+        idx = Data.star_index.get(self.name)
+        if idx is None:
             logger.error("Star '"+self.name+"' not found in data object.")
             return None
+        logger.info("Star '"+self.name+"' found in data object.")
 
         parameters = ['teff', 'err_teff', 'logg', 'err_logg',
                       'feh', 'err_feh', 'vt', 'err_vt', 'rho', 'err_rho',
@@ -126,7 +482,7 @@ class Star:
         msg = []
         for par in parameters:
             if par in Data.star_data.keys():
-                if Data.star_data[par][idx] != None:
+                if not is_missing(Data.star_data[par][idx]):
                     setattr(self, par, Data.star_data[par][idx])
                     msg.append(par)
         if msg:
@@ -136,7 +492,7 @@ class Star:
         # gets line data excluding cells with no ew:
         #if hasattr(Data, 'lines'):
         if Data.lines:
-            idx = np.where(Data.lines[self.name] != np.nan)
+            idx = np.where(Data.has_ew(self.name))
             self.linelist = {'wavelength': Data.lines['wavelength'][idx],
                              'species': Data.lines['species'][idx],
                              'ep': Data.lines['ep'][idx],
@@ -150,7 +506,7 @@ class Star:
         """If teff, logg, and feh are set attributes for a Star object,
         a model atmosphere will be interpolated from one of the
         available grids: 'odfnew' (default), 'aodfnew', 'over', 'nover'
-        (all Kurucz), or 'marcs'.
+        (all Kurucz), or 'marcs'. Models are reused through model_cache.
         """
         if self.teff == None or self.logg == None or self.feh == None:
             logger.error('To create model atmosphere, star must have all '+
@@ -161,8 +517,7 @@ class Star:
             feh = self.feh_model
         else:
             feh = self.feh
-        x = modatm.interpolate(self.teff, self.logg,
-                               feh, grid)
+        x = model_cache.get(self.teff, self.logg, feh, grid)
         if x != None:
             self.model_atmosphere = x
             self.model_atmosphere_grid = grid
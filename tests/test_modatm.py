@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from q2 import modatm
+
+griddata = pytest.importorskip('scipy.interpolate').griddata
+
+
+def kurucz_like_model(n=72, scale=1.0):
+    rhox = scale*np.geomspace(1e-3, 1e2, n)
+    abross = 1e-3*np.geomspace(1, 1e4, n)**0.8
+    return rhox, abross
+
+
+def test_tau_ross_is_not_monotonic_at_the_top():
+    tau = modatm.tau_ross(*kurucz_like_model())
+    assert tau[0] > tau[1]
+
+
+def test_resample_matches_griddata_on_non_monotonic_tau():
+    rhox, abross = kurucz_like_model()
+    tau = modatm.tau_ross(rhox, abross)
+    y = np.column_stack([rhox, abross, np.log(rhox)])
+    tau_new = np.geomspace(tau[0], tau[-1], len(tau))
+    expected = np.column_stack([griddata(tau, y[:, c], tau_new)
+                                for c in range(y.shape[1])])
+    np.testing.assert_allclose(modatm.resample(tau, y, tau_new), expected,
+                               rtol=1e-12)
@@ -17,19 +17,73 @@ def linterp(m0, m1, p0, p1, p):
         m[col] = (1.-s)*m0[col] + s*m1[col]
     return m
 
-def linfit(x, y):
+def linfit(x, y, sigma_y=None):
     """Linear fit that returns only zero value, slope, and slope error
+
+    x and y can also be 2-D arrays with one series per row (e.g., all the
+    perturbations of errors.error_one), padded with NaN if the series have
+    different lengths. All rows are fitted at once and arrays of zero
+    values, slopes, and slope errors are returned.
+
+    If sigma_y (uncertainties of y, same shape as y) is given, the fit is
+    weighted by 1/sigma_y**2 and the slope error follows from sigma_y
+    instead of from the scatter about the fit.
     """
-    n = len(x)
-    dp = n*sum(x**2) - (sum(x)**2)
-    a = (sum(x**2)*sum(y) - sum(x)*sum(x*y))/dp
-    b = (n*sum(x*y) - sum(x)*sum(y))/dp
-    sigma = np.sqrt(sum((y-a-b*x)**2)/(n-2))
-    err_a = np.sqrt((sigma**2/dp)*sum(x**2))
-    err_b = np.sqrt((sigma**2/dp)*n)
-    #return b, a, sigma, err_b, err_a
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    ok = np.isfinite(x) & np.isfinite(y)
+    if sigma_y is None:
+        w = ok.astype(float)
+    else:
+        sigma_y = np.asarray(sigma_y, dtype=float)
+        ok &= np.isfinite(sigma_y) & (sigma_y > 0)
+        w = np.where(ok, 1./np.where(ok, sigma_y, 1.)**2, 0.)
+    x = np.where(ok, x, 0.)
+    y = np.where(ok, y, 0.)
+    n = np.sum(w, axis=-1)
+    sx = np.sum(w*x, axis=-1)
+    sy = np.sum(w*y, axis=-1)
+    sxx = np.sum(w*x**2, axis=-1)
+    sxy = np.sum(w*x*y, axis=-1)
+    dp = n*sxx - sx**2
+    a = (sxx*sy - sx*sxy)/dp
+    b = (n*sxy - sx*sy)/dp
+    if sigma_y is None:
+        res = y - np.expand_dims(a, -1) - np.expand_dims(b, -1)*x
+        sigma = np.sqrt(np.sum(w*res**2, axis=-1)/(n-2))
+        err_b = np.sqrt((sigma**2/dp)*n)
+    else:
+        err_b = np.sqrt(n/dp)
     return a, b, err_b
 
+def match_lines(ww, ww_ref, ab=None, ab_ref=None):
+    """Matches the lines of a star (wavelengths ww) to those of a reference
+    star (ww_ref) by wavelength
+
+    Returns (k, k_ref, difab): ww[k] == ww_ref[k_ref], with k in the
+    order of ww. If the abundances ab and ab_ref are given, difab is
+    ab - ab_ref for every line in ww, NaN for the lines that the reference
+    star does not have; otherwise difab is None.
+    """
+    ww = np.asarray(ww)
+    ww_ref = np.asarray(ww_ref)
+    order = np.argsort(ww_ref, kind='stable')
+    ws = ww_ref[order]
+    pos = np.searchsorted(ws, ww)
+    pos[pos >= len(ws)] = 0
+    if len(ws):
+        hit = ws[pos] == ww
+    else:
+        hit = np.zeros(len(ww), dtype=bool)
+    k = np.flatnonzero(hit)
+    k_ref = order[pos[hit]]
+    difab = None
+    if ab is not None and ab_ref is not None:
+        difab = np.full(len(ww), np.nan)
+        difab[k] = np.asarray(ab, dtype=float)[k] - \
+                   np.asarray(ab_ref, dtype=float)[k_ref]
+    return k, k_ref, difab
+
 def read_csv(csv_file, file_type=None):
     """Reads CSV file with header and sends data to dictionary
 
@@ -37,9 +91,11 @@ def read_csv(csv_file, file_type=None):
 
     This routine was written specifically for q2 and is not meant
     to be a generic CSV file reader. The first row must be a header column
-    and it must not have empty cells. No commented rows are allowed. Empty
-    data rows will be read as None. The output is a dictionary of numpy
-    arrays.
+    and it must not have empty cells. No commented rows are allowed. The
+    output is a dictionary of numpy arrays. The type of each column is
+    decided once: numeric columns are parsed in bulk into float arrays
+    (int for complete 'teff' columns) with NaN for empty cells; empty
+    cells of text columns are read as None.
 
     If file_type is None, it does not matter what the header contains,
     however, all data must be numbers.
@@ -48,23 +104,57 @@ def read_csv(csv_file, file_type=None):
     'wavelength', 'species', 'ep', and 'gf'.
     """
 
-    with open(csv_file, 'rU') as f:
-        x = f.readlines()
+    with open(csv_file, 'r') as f:
+        x = f.read().splitlines()
 
     keys = [key.strip("\n") for key in x[0].split(",")]
+    if not check_keys(keys, csv_file, file_type):
+        return None
+
+    #split every row once and transpose rows into columns
+    nkeys = len(keys)
+    rows = []
+    for xi in x[1:]:
+        if xi.strip(" ") == "":
+            continue
+        row = xi.split(",")
+        if len(row) < nkeys:
+            row += [""]*(nkeys-len(row))
+        rows.append(row[:nkeys])
+    if rows:
+        columns = list(zip(*rows))
+    else:
+        columns = [()]*nkeys
+
+    dictionary = {}
+    for key, column in zip(keys, columns):
+        dictionary[key] = _convert_column(key, column, file_type, csv_file)
+    if file_type == "stars":
+        if [None] in dictionary["id"]:
+            logger.error("The 'id' column cannot have empty rows.")
+            return None
+        if len(set(dictionary["id"])) < len(dictionary["id"]):
+            logger.error("There are duplicates in 'id' column.")
+            return None
+    return dictionary
+
+def check_keys(keys, csv_file, file_type):
+    """Checks the header keys of a CSV file as described in read_csv.
+    Returns False (and logs why) if they are not valid.
+    """
     if (len(keys) != len(set(keys))):
         logger.error("First row of CSV file (keys in "+csv_file+\
                      ") has duplicates.")
-        return None
+        return False
     if "" in keys:
         logger.error("First row of CSV file (keys in "+csv_file+\
                      ") has empty columns.")
-        return None
+        return False
 
     if file_type == "stars":
         if "id" not in keys:
             logger.error("Stars CSV file must have an 'id' column.")
-            return None
+            return False
         important_pars = ["teff", "logg", "feh"]
         for par in important_pars:
             if par not in keys:
@@ -75,41 +165,118 @@ def read_csv(csv_file, file_type=None):
         or "ep" not in keys or "gf" not in keys) and file_type=="lines":
         logger.error("Lines CSV file must have all of these columns: "+\
                      "'wavelength', 'species', 'ep', and 'gf'.")
+        return False
+    return True
+
+def _convert_column(key, column, file_type, csv_file):
+    """Converts the cells of a CSV column (strings) to a numpy array
+    following the read_csv rules for the column key and file_type.
+    """
+    is_teff = "teff" in key
+    is_float = "logg" in key or "feh" in key or "vt" in key or \
+               "rho" in key or key == "v" or "err" in key or \
+               "plx" in key
+    if is_teff or is_float or file_type in [None, "lines"]:
+        values = _float_column(column)
+        if values is None:
+            if is_teff or is_float or file_type == None:
+                raise ValueError("Non-numeric data in column '"+key+\
+                                 "' of "+csv_file)
+            #lines file column that is not all numbers: cell by cell
+            values = np.array([_float_or_string(xij) for xij in column])
+        elif is_teff:
+            values = np.round(values)
+            if not is_float and file_type != "lines" and \
+               not np.isnan(values).any():
+                values = values.astype(int)
+    else:
+        values = np.array([xij if xij.strip(" ") != "" else None
+                           for xij in column])
+    return values
+
+#cells between the offsets kept by index_csv in every row
+CSV_INDEX_BLOCK = 128
+
+def index_csv(csv_file, block=CSV_INDEX_BLOCK):
+    """Scans a CSV file once and returns its keys and the byte offsets
+    of its rows, so that single columns can later be read with
+    read_csv_column without holding the whole file in memory.
+
+    The index is a tuple (keys, row_starts, block_starts, block): data
+    row i starts at byte row_starts[i], and cell b*block of that row
+    starts block_starts[i,b] bytes later (-1 if the row is shorter).
+    Cells in between are found when they are read, so the index takes
+    only about 4/block bytes per cell.
+    """
+    with open(csv_file, 'rb') as f:
+        header = f.readline()
+        keys = [key.strip("\n") for key in
+                header.decode().rstrip("\r\n").split(",")]
+        nblocks = (len(keys)-1)//block+1
+        row_starts, block_starts = [], []
+        position = len(header)
+        for xi in f:
+            row = xi.rstrip(b"\r\n")
+            if row.strip(b" ") != b"":
+                commas = np.flatnonzero(np.frombuffer(row, np.uint8) == 44)
+                starts = np.full(nblocks, -1, dtype=np.int32)
+                starts[0] = 0
+                first = commas[block-1::block][:nblocks-1]
+                starts[1:len(first)+1] = first+1
+                row_starts.append(position)
+                block_starts.append(starts)
+            position += len(xi)
+    row_starts = np.array(row_starts, dtype=np.int64)
+    block_starts = np.array(block_starts, dtype=np.int32).\
+                   reshape(len(row_starts), nblocks)
+    return keys, row_starts, block_starts, block
+
+def read_csv_column(csv_file, index, key, file_type=None):
+    """Reads one column of a CSV file using an index made by index_csv.
+    The column is converted as it would have been by read_csv.
+    """
+    keys, row_starts, block_starts, block = index
+    k = keys.index(key)
+    nblocks = block_starts.shape[1]
+    b, j = divmod(k, block)
+    column = []
+    with open(csv_file, 'rb') as f:
+        for row_start, starts in zip(row_starts, block_starts):
+            if starts[b] < 0:
+                column.append("")
+                continue
+            f.seek(row_start+int(starts[b]))
+            if b+1 < nblocks and starts[b+1] >= 0:
+                x = f.read(int(starts[b+1])-int(starts[b]))
+            else:
+                x = f.readline().rstrip(b"\r\n")
+            cells = x.split(b",", j+1)
+            column.append(cells[j].decode() if j < len(cells) else "")
+    return _convert_column(key, column, file_type, csv_file)
+
+def is_missing(x):
+    """True for an empty CSV cell as returned by read_csv: None in text
+    columns, NaN in numeric ones.
+    """
+    return x is None or (isinstance(x, float) and np.isnan(x))
+
+def _float_column(column):
+    """Converts a column of CSV cells to a float array in one pass, with
+    NaN for empty cells. Returns None if some cell is not a number.
+    """
+    cells = np.char.strip(np.array(column, dtype=str))
+    empty = cells == ""
+    values = np.full(len(cells), np.nan)
+    try:
+        values[~empty] = cells[~empty].astype(float)
+    except ValueError:
         return None
+    return values
 
-    dictionary = {}
-    for key in keys:
-        dictionary[key] = []
-    for xi in x[1:]:
-        for key, xij in zip(keys,xi.split(",")):
-            xij = xij.strip("\n")
-            if xij.strip(" ") == "":
-                xij = None
-            if "teff" in key and xij != None:
-                xij = int(round(float(xij)))
-            if ("logg" in key or "feh" in key or "vt" in key or "rho" in key)\
-               and xij != None:
-                xij = float(xij)
-            if (key == "v" or "err" in key or "plx" in key)\
-               and xij != None:
-                xij = float(xij)
-            if file_type == "lines" and xij != None:
-                try:
-                    xij = float(xij)
-                except:
-                    xij = xij
-            if file_type == None:
-                xij = float(xij)
-            dictionary[key].append(xij)
-    for key in keys:
-        dictionary[key] = np.array(dictionary[key])
-    if file_type == "stars":
-        if [None] in dictionary["id"]:
-            logger.error("The 'id' column cannot have empty rows.")
-            return None
-        ambiguous_ids = [idx for idx in dictionary["id"]\
-                        if len(dictionary["id"][dictionary["id"]==idx]) > 1]
-        if len(ambiguous_ids) > 1:
-            logger.error("There are duplicates in 'id' column.")
-            return None
-    return dictionary
+def _float_or_string(xij):
+    if xij.strip(" ") == "":
+        return None
+    try:
+        return float(xij)
+    except ValueError:
+        return xij